@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Collect concurrent submissions for a short window and process them as one batch"""
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        batch_size: int = 8,
+        max_wait: float = 0.05
+    ):
+        self.process_batch = process_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._full: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Items the worker has taken off the queue but not yet dispatched
+        self._collecting: List[Tuple[Any, asyncio.Future]] = []
+        # The loop only keeps weak references to tasks, so in-flight batches are held here
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker is not None and not self._worker.done():
+            return
+        # Queues and tasks are bound to one event loop, so rebuild them per loop
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._worker = loop.create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """Queue an item and wait for its result from the next batch"""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self._queue.put_nowait((item, future))
+        # The worker already holds the first item of the batch it is collecting
+        if self._queue.qsize() >= self.batch_size - 1:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = self._collecting = [await self._queue.get()]
+            self._full.clear()
+            if self._queue.qsize() < self.batch_size - 1:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._collecting = []
+            # Dispatch without blocking collection of the next batch
+            task = self._loop.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _fail(batch: List[Tuple[Any, asyncio.Future]], error: BaseException):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.process_batch(items)
+            if len(results) != len(items):
+                raise ValueError(f"Batch returned {len(results)} results for {len(items)} items")
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("Batcher closed"))
+            raise
+        except Exception as e:
+            logger.warning(f"Batch of {len(items)} failed: {e}")
+            self._fail(batch, e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """Stop the background worker and fail every queued or in-flight submission"""
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+        closed = RuntimeError("Batcher closed")
+        self._fail(self._collecting, closed)
+        self._collecting = []
+        while self._queue is not None and not self._queue.empty():
+            self._fail([self._queue.get_nowait()], closed)
+        # Cancelled dispatches fail their own futures
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
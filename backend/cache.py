@@ -0,0 +1,102 @@
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Hashable, List, Optional
+
+import numpy as np
+from cachetools import LRUCache, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Exact-match TTL cache for LLM responses"""
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def make_key(key: Hashable) -> bytes:
+        # Store a fixed-size digest rather than the (possibly multi-KB) prompt text
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        return self._cache.get(self.make_key(key))
+
+    def set(self, key: Hashable, value: Any):
+        self._cache[self.make_key(key)] = value
+
+    async def get_or_set(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value for `key`, computing and storing it on a miss"""
+        cached = self.get(key)
+        if cached is not None:
+            logger.debug("Response cache hit")
+            return cached
+        value = await compute()
+        self.set(key, value)
+        return value
+
+
+class SemanticCache:
+    """Embedding-similarity cache for LLM responses, partitioned by namespace"""
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[List[float]]],
+        threshold: float = 0.92,
+        max_entries: int = 1000,
+        max_namespaces: int = 1000,
+        enabled: bool = True
+    ):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # namespace -> ((n, dim) matrix of unit vectors, the n cached values). Namespaces can
+        # carry user-supplied text, so the least recently used ones are evicted past the cap
+        self._namespaces: LRUCache = LRUCache(maxsize=max_namespaces)
+
+    def lookup(self, namespace: Hashable, vector: np.ndarray) -> Optional[Any]:
+        """Return the value of the most similar entry above the threshold"""
+        entry = self._namespaces.get(namespace)
+        if entry is None:
+            return None
+        vectors, values = entry
+        scores = vectors @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return values[best]
+        return None
+
+    def store(self, namespace: Hashable, vector: np.ndarray, value: Any):
+        """Add an entry, evicting the oldest one once the namespace is full"""
+        entry = self._namespaces.get(namespace)
+        if entry is None:
+            self._namespaces[namespace] = (vector[np.newaxis, :], [value])
+            return
+        vectors, values = entry
+        if len(values) >= self.max_entries:
+            vectors = vectors[1:]
+            del values[0]
+        self._namespaces[namespace] = (np.vstack([vectors, vector]), values)
+
+    async def get_or_set(self, namespace: Hashable, text: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Return a cached value for text similar to `text`, computing it on a miss"""
+        if not self.enabled:
+            return await compute()
+
+        try:
+            vector = np.asarray(await self.embed(text), dtype=np.float32)
+            vector /= np.linalg.norm(vector)
+        except Exception as e:
+            # The cache must never fail a request; fall through to the LLM
+            logger.warning(f"Embedding failed, skipping semantic cache: {e}")
+            return await compute()
+
+        cached = self.lookup(namespace, vector)
+        if cached is not None:
+            logger.debug("Semantic cache hit for %s", namespace)
+            return cached
+
+        value = await compute()
+        self.store(namespace, vector, value)
+        return value
@@ -1,7 +1,7 @@
 import os
 from typing import List
 from pydantic_settings import BaseSettings
-from pydantic import field_validator, ConfigDict
+from pydantic import AliasChoices, Field, field_validator, ConfigDict
 
 
 class Settings(BaseSettings):
@@ -12,20 +12,61 @@ class Settings(BaseSettings):
     secret_key: str = "your-super-secret-key-change-this-in-production"
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 60
+    principal_cache_max_entries: int = 10000
+    principal_cache_ttl_seconds: int = 60
+    login_cache_max_entries: int = 10000
+    login_cache_ttl_seconds: int = 60
     
     # OpenAI
     openai_api_key: str = ""
+    embedding_model: str = "text-embedding-3-small"
+    openai_max_connections: int = 1000
+    openai_max_keepalive_connections: int = 500
+    openai_timeout: float = 60.0
+    openai_connect_timeout: float = 5.0
+    openai_pool_timeout: float = 5.0
+    openai_request_deadline: float = 90.0
+    openai_max_retries: int = 3
+    openai_requests_per_minute: int = 3500
+    openai_tokens_per_minute: int = 200000
+    llm_model: str = "gpt-4o-mini"
+    llm_max_tokens: int = 150
+    review_model: str = "gpt-4o-mini"
+    review_max_tokens: int = 600
+    max_input_tokens: int = 1000
+    max_code_tokens: int = 3000
+    max_example_tokens: int = 400
+    precompute_function_definitions: bool = True
+    
+    # Response caches
+    response_cache_max_entries: int = 10000
+    response_cache_ttl_seconds: int = 3600
+    semantic_cache_enabled: bool = True
+    semantic_cache_threshold: float = 0.92
+    semantic_cache_max_entries: int = 1000
+    semantic_cache_max_namespaces: int = 1000
+    
+    # Cross-request batching of LLM calls
+    llm_batching_enabled: bool = False
+    llm_batch_size: int = 8
+    llm_batch_max_wait_ms: int = 50
+    combine_review_calls: bool = False
     
     # Server
     host: str = "0.0.0.0"
     port: int = 8000
     debug: bool = False
+    # Process count as set by the launcher (gunicorn also reads WEB_CONCURRENCY)
+    workers: int = Field(1, validation_alias=AliasChoices("web_concurrency", "workers"))
     
     # CORS
     allowed_origins: List[str] = ["http://localhost:3000", "https://leetcoach.vercel.app"]
+    cors_max_age: int = 86400
     
     # Rate Limiting
     rate_limit_per_minute: int = 60
+    rate_limit_max_ips: int = 100000
+    redis_url: str = ""
     
     # Logging
     log_level: str = "INFO"
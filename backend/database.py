@@ -1,13 +1,46 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from config import settings
 from models import Base
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+# Map sync driver schemes to their asyncio counterparts
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+
+def to_async_url(url: str) -> str:
+    scheme, separator, rest = url.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + separator + rest
+
+
+SQLALCHEMY_DATABASE_URL = to_async_url(settings.database_url)
+
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    # aiosqlite defaults to NullPool; pool explicitly so every backend reuses connections
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=True
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # Pooled connections live for the whole process, so a per-connection page
+        # cache stays warm; WAL lets readers proceed while a write commits
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-16000")
+        cursor.close()
+
 
-# Create tables
-Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+async def init_db():
+    """Create tables"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
@@ -1,39 +1,327 @@
-import json
+import asyncio
+import atexit
+import hashlib
+import hmac
 import logging
+import os
+import queue
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI, Request, Depends, HTTPException, status
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-import openai
-import os
+from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from pydantic import ValidationError as PydanticValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from openai import AsyncOpenAI
+import httpx
+import orjson
+import tiktoken
+from pathlib import Path
+from cachetools import TTLCache
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock; precompute then runs in every process
+    fcntl = None
 
 # Import our production-ready modules
 from config import settings
 from models import (
-    User, Base, ClarifyRequest, BruteForceRequest, OptimizeRequest, 
+    User, ClarifyRequest, BruteForceRequest, OptimizeRequest, 
     FunctionDefinitionRequest, CodeReviewRequest, StartSessionRequest,
     ClarifyResponse, BruteForceResponse, OptimizeResponse,
-    FunctionDefinitionResponse, CodeReviewResponse
+    FunctionDefinitionResponse, CodeReviewResponse, UserResponse,
+    BruteForceOptimizeRequest, BruteForceOptimizeResponse,
+    SessionFeedbackRequest, SessionFeedbackResponse, ReviewResponse, CombinedReviewResponse, SUPPORTED_LANGUAGES
 )
-from database import SessionLocal, engine
+from database import AsyncSessionLocal, engine, init_db
 from exceptions import (
     LeetCoachException, ValidationError, AuthenticationError,
     NotFoundError, OpenAIError, handle_leetcoach_exception
 )
 from middleware import setup_middleware
+from cache import ResponseCache, SemanticCache
+from batching import MicroBatcher
+from ratelimit import TokenBucket
 from passlib.context import CryptContext
-from jose import JWTError, jwt
+import jwt
 from datetime import datetime, timedelta
 
-# Configure logging
+# Configure logging: handlers on the event loop only enqueue records, and a listener
+# thread formats and writes them so stdout/pipe writes never block request handling
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+log_queue_handler = QueueHandler(log_queue)
+# The queue handler only merges args into the message; the listener applies the real format
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=getattr(logging, settings.log_level),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    handlers=[log_queue_handler]
 )
 logger = logging.getLogger(__name__)
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Pooled HTTP client so OpenAI calls reuse keep-alive TLS connections
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=settings.openai_max_connections,
+        max_keepalive_connections=settings.openai_max_keepalive_connections
+    ),
+    # Fail fast when OpenAI is unreachable or every pooled connection is busy,
+    # rather than letting requests pile up behind a stalled upstream
+    timeout=httpx.Timeout(
+        settings.openai_timeout,
+        connect=settings.openai_connect_timeout,
+        pool=settings.openai_pool_timeout
+    )
+)
+
+# Shared async OpenAI client, reused by every agent; the SDK backs off and retries on 429s
+client = AsyncOpenAI(
+    api_key=settings.openai_api_key,
+    http_client=http_client,
+    max_retries=settings.openai_max_retries
+)
+
+# Decided once: without a real key every agent answers with canned responses
+IS_DUMMY_KEY = not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development"
+if IS_DUMMY_KEY:
+    logger.warning("OpenAI API key not set. Agents will return canned responses.")
+
+
+# Rough size of a token when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+# Server processes sharing the account; debug runs a single reloading process
+WORKER_COUNT = 1 if settings.debug else max(settings.workers, 1)
+
+# Proactive throttling keeps bursts under the account's RPM/TPM limits instead of
+# running into 429s and backoff. The buckets are per process, so each worker gets an
+# equal share of the account-wide budget
+request_limiter = (
+    TokenBucket(settings.openai_requests_per_minute / WORKER_COUNT)
+    if settings.openai_requests_per_minute > 0 else None
+)
+token_limiter = (
+    TokenBucket(settings.openai_tokens_per_minute / WORKER_COUNT)
+    if settings.openai_tokens_per_minute > 0 else None
+)
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    """Tokenizer for the chat model, or None when its BPE file cannot be loaded"""
+    try:
+        return tiktoken.encoding_for_model(settings.llm_model)
+    except Exception as e:
+        # tiktoken downloads the BPE file on first use; never fail a request over it
+        logger.warning(f"Tokenizer unavailable, estimating tokens from length: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text: str, limit: int) -> str:
+    """Cut text down to at most `limit` tokens"""
+    # Every token covers at least one character, so short text needs no encoding
+    if len(text) <= limit:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:limit * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text)
+    return text if len(tokens) <= limit else encoding.decode(tokens[:limit])
+
+
+def estimate_tokens(request) -> int:
+    """Token budget of a chat request: the prompt plus the completion cap"""
+    # The per-question system headers are large and constant, so their counts are precomputed
+    prompt_tokens = sum(
+        SYSTEM_HEADER_TOKENS.get(message["content"]) or count_tokens(message["content"])
+        for message in request["messages"]
+    )
+    return prompt_tokens + request.get("max_tokens", 0)
+
+
+async def openai_request(create, tokens: int = 0, **kwargs):
+    """Send an OpenAI request once the shared rate limits allow it, bounded by the request deadline"""
+    if request_limiter is not None:
+        await request_limiter.acquire()
+    if token_limiter is not None and tokens:
+        await token_limiter.acquire(tokens)
+    try:
+        # Bounds the whole call, SDK retries and backoff included
+        return await asyncio.wait_for(create(**kwargs), settings.openai_request_deadline)
+    except asyncio.TimeoutError:
+        raise OpenAIError(f"OpenAI request timed out after {settings.openai_request_deadline:g}s")
+
+
+async def create_chat_completion(**kwargs):
+    """Create a chat completion once the shared rate limits allow it"""
+    tokens = estimate_tokens(kwargs) if token_limiter is not None else 0
+    return await openai_request(client.chat.completions.create, tokens, **kwargs)
+
+
+async def embed_text(text: str):
+    """Embed text for semantic cache lookups"""
+    # Embedding tokens have their own per-model limit, so only the request slot is taken
+    response = await openai_request(client.embeddings.create, model=settings.embedding_model, input=text)
+    return response.data[0].embedding
+
+
+# Exact-match cache checked before the semantic cache
+response_cache = ResponseCache(
+    maxsize=settings.response_cache_max_entries,
+    ttl=settings.response_cache_ttl_seconds
+)
+
+# Semantic cache for feedback responses, namespaced per agent and question
+semantic_cache = SemanticCache(
+    embed_text,
+    threshold=settings.semantic_cache_threshold,
+    max_entries=settings.semantic_cache_max_entries,
+    max_namespaces=settings.semantic_cache_max_namespaces,
+    enabled=settings.semantic_cache_enabled
+)
+
+
+def normalize_text(text: str) -> str:
+    """Collapse case and whitespace so trivially different inputs share an exact-cache entry"""
+    return " ".join(text.lower().split())
+
+
+async def cached_feedback(namespace, text, compute):
+    """Look up a feedback response in the exact cache, then the semantic cache"""
+    return await response_cache.get_or_set(
+        (namespace, normalize_text(text)),
+        lambda: semantic_cache.get_or_set(namespace, text, compute)
+    )
+
+
+async def cached_stream(namespace, text, stream):
+    """Send an exact-cache hit as a single chunk; otherwise stream tokens and cache the full text"""
+    # Streams skip the semantic cache: its embedding call would delay the first token
+    key = (namespace, normalize_text(text))
+    cached = response_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+    tokens = []
+    async for token in stream():
+        tokens.append(token)
+        yield token
+    response_cache.set(key, "".join(tokens))
+
+
+async def stream_chat_completion(**kwargs):
+    """Yield content deltas from a streamed chat completion"""
+    response = await create_chat_completion(stream=True, **kwargs)
+    async for chunk in response:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+
+CLARIFY_BATCH_SYSTEM_PROMPT = (
+    "You are a precise coding interview coach who provides problem-specific guidance. "
+    "You will receive several independent requests, each under a '### Request <n>' header "
+    "numbered from 0. Answer each one on its own, following its instructions, and reply with "
+    'a JSON object {"responses": [...]} whose n-th string answers request n.'
+)
+
+
+async def complete_clarification_batch(requests):
+    """Answer several clarification requests with a single completion"""
+    if len(requests) == 1:
+        response = await create_chat_completion(**requests[0])
+        return [response.choices[0].message.content]
+
+    # Requests may be about different questions, so each one keeps its own problem header
+    prompt = "\n\n".join(
+        f"### Request {i}\n" + "\n\n".join(message["content"] for message in request["messages"])
+        for i, request in enumerate(requests)
+    )
+    response = await create_chat_completion(
+        model=requests[0]["model"],
+        messages=[{"role": "system", "content": CLARIFY_BATCH_SYSTEM_PROMPT},
+                  {"role": "user", "content": prompt}],
+        max_tokens=sum(request["max_tokens"] for request in requests),
+        temperature=requests[0]["temperature"],
+        response_format={"type": "json_object"}
+    )
+    responses = orjson.loads(response.choices[0].message.content).get("responses")
+    if not isinstance(responses, list) or not all(isinstance(r, str) for r in responses):
+        raise ValueError("Malformed batch response")
+    return responses
+
+
+# Optional cross-request batching of clarification calls
+clarification_batcher = MicroBatcher(
+    complete_clarification_batch,
+    batch_size=settings.llm_batch_size,
+    max_wait=settings.llm_batch_max_wait_ms / 1000
+) if settings.llm_batching_enabled else None
+
+
+def format_sse(data: str, event: str = None) -> str:
+    """Format a Server-Sent Events frame, one data line per text line"""
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+def sse_response(tokens) -> StreamingResponse:
+    """Wrap an async token iterator in a text/event-stream response"""
+    async def event_stream():
+        try:
+            async for token in tokens:
+                if token:
+                    yield format_sse(token)
+        except LeetCoachException as e:
+            yield format_sse(e.message, event="error")
+        yield format_sse("[DONE]")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    # Loading the tokenizer may download its BPE file, so do it before serving and off the loop
+    await asyncio.to_thread(get_encoding)
+    for question in QUESTIONS:
+        get_system_header(question)
+    precompute_task = None
+    if settings.precompute_function_definitions and not IS_DUMMY_KEY:
+        # Fill the stub file in the background so startup is not held up by the LLM
+        precompute_task = asyncio.create_task(
+            function_definition_agent.precompute(QUESTIONS, SUPPORTED_LANGUAGES)
+        )
+    yield
+    if precompute_task is not None:
+        precompute_task.cancel()
+    if clarification_batcher is not None:
+        await clarification_batcher.close()
+    await http_client.aclose()
+    await engine.dispose()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -41,33 +329,103 @@ app = FastAPI(
     description="AI-powered coding interview simulator",
     version="1.0.0",
     docs_url="/docs" if settings.debug else None,
-    redoc_url="/redoc" if settings.debug else None
+    redoc_url="/redoc" if settings.debug else None,
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Setup middleware
 setup_middleware(app)
 
 # Load questions from questions.json
+BASE_DIR = Path(__file__).resolve().parent
+QUESTIONS_PATH = BASE_DIR / "questions.json"
+FUNCTION_DEFINITIONS_PATH = BASE_DIR / "function_defs.json"
 try:
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    QUESTIONS_PATH = os.path.join(BASE_DIR, "questions.json")
-    with open(QUESTIONS_PATH) as f:
-        QUESTIONS = json.load(f)
+    QUESTIONS = orjson.loads(QUESTIONS_PATH.read_bytes())
     logger.info(f"Loaded {len(QUESTIONS)} questions")
 except Exception as e:
     logger.error(f"Failed to load questions: {e}")
     QUESTIONS = []
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+QUESTIONS_BY_ID = {q["id"]: q for q in QUESTIONS}
+DEFAULT_QUESTION = QUESTIONS[0] if QUESTIONS else None
+# The question list is fixed for the process lifetime, so serialize it once
+QUESTIONS_PAYLOAD = orjson.dumps([{"id": q["id"], "title": q["title"]} for q in QUESTIONS])
+
+
+def select_examples(examples, budget: int):
+    """Render examples in order until `budget` tokens are used; the first one is always kept"""
+    lines, used = [], 0
+    for ex in examples:
+        line = f"Input: {ex['input']} | Output: {ex['output']}"
+        cost = count_tokens(line)
+        if lines and used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    return lines
+
+def format_problem_details(question) -> str:
+    """Render the PROBLEM DETAILS block shared by the agent prompts"""
+    q_examples = "\n".join(select_examples(question.get("examples", []), settings.max_example_tokens))
+    q_constraints = "\n".join(question.get("constraints", []))
+    return (
+        f"Title: {question.get('title', '')}\n"
+        f"Description: {question.get('description', '')}\n"
+        f"Examples: {q_examples}\n"
+        f"Constraints: {q_constraints}"
+    )
+
+SYSTEM_HEADER_TEMPLATE = """You are an expert coding interview coach. The candidate is working on the coding problem below, and every task you receive is about this problem. Be specific to it: reference its actual examples and constraints instead of giving generic advice.
+
+PROBLEM DETAILS:
+{problem_details}"""
+
+# Every stage call for a question leads with the same system message, so the provider's
+# automatic prefix caching can reuse it; only the user message varies between calls.
+# Filled at startup, once the tokenizer that budgets the examples is loaded
+SYSTEM_HEADERS = {}
+# Token count of each cached header, keyed by its text, for rate-limit estimates
+SYSTEM_HEADER_TOKENS = {}
+
+def get_system_header(question) -> str:
+    header = SYSTEM_HEADERS.get(question.get("id"))
+    if header is None:
+        header = SYSTEM_HEADER_TEMPLATE.format(problem_details=format_problem_details(question))
+        if question.get("id") in QUESTIONS_BY_ID:
+            SYSTEM_HEADERS[question["id"]] = header
+            SYSTEM_HEADER_TOKENS[header] = count_tokens(header)
+    return header
+
+# Password hashing: new hashes use argon2id; existing bcrypt hashes still
+# verify and are upgraded on the next successful login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1
+)
+
+# Verified against on unknown usernames so a miss costs as much as a wrong password
+DUMMY_PASSWORD_HASH = pwd_context.hash("leetcoach-dummy-password")
+
+# Recently verified logins, so a client re-authenticating in a loop skips the hash.
+# Entries are keyed digests under a per-process secret: neither the password nor an
+# offline-crackable hash of it is kept in memory
+LOGIN_CACHE_SECRET = secrets.token_bytes(32)
+verified_logins = TTLCache(maxsize=settings.login_cache_max_entries, ttl=settings.login_cache_ttl_seconds)
+
+def login_cache_key(username: str, password: str, hashed_password: str) -> bytes:
+    # The stored hash is part of the key, so a password change invalidates old entries
+    message = "\0".join((username, password, hashed_password)).encode()
+    return hmac.new(LOGIN_CACHE_SECRET, message, hashlib.sha256).digest()
 
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -75,15 +433,46 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+# Signing key and token lifetime never change at runtime
+JWT_SECRET = settings.secret_key.encode()
+ACCESS_TOKEN_TTL_SECONDS = settings.access_token_expire_minutes * 60
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
-    return encoded_jwt
+    ttl = expires_delta.total_seconds() if expires_delta else ACCESS_TOKEN_TTL_SECONDS
+    # exp is a NumericDate, so an epoch int avoids building datetime objects
+    to_encode = {**data, "exp": int(time.time() + ttl)}
+    return jwt.encode(to_encode, JWT_SECRET, algorithm=settings.algorithm)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
+
+# Token -> (user, exp) for recently seen tokens, so repeat calls skip the decode and the
+# user query; account changes such as deactivation take up to the TTL to apply
+principal_cache = TTLCache(maxsize=settings.principal_cache_max_entries, ttl=settings.principal_cache_ttl_seconds)
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> User:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+    cached = principal_cache.get(token)
+    if cached is not None:
+        user, expires_at = cached
+        # Never serve a token past its own expiry, even inside the cache TTL
+        if expires_at > time.time():
+            return user
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[settings.algorithm])
+    except jwt.InvalidTokenError:
+        raise credentials_exception
+    username = payload.get("sub")
+    if username is None:
+        raise credentials_exception
+    user = await db.scalar(select(User).where(User.username == username))
+    if user is None or not user.is_active:
+        raise credentials_exception
+    principal_cache[token] = (user, payload.get("exp", float("inf")))
+    return user
 
 # Global exception handler
 @app.exception_handler(LeetCoachException)
@@ -94,7 +483,7 @@ async def leetcoach_exception_handler(request: Request, exc: LeetCoachException)
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {str(exc)}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Internal server error", "message": "Something went wrong"}
     )
@@ -117,41 +506,8 @@ async def login_options():
 async def register_options():
     return {"message": "OK"}
 
-# Agent classes with improved error handling
-class QuestionAgent:
-    def get_question(self, question_id=None):
-        if not QUESTIONS:
-            raise NotFoundError("No questions available")
-        
-        if question_id is not None:
-            for q in QUESTIONS:
-                if q["id"] == question_id:
-                    return q
-            raise NotFoundError(f"Question with ID {question_id} not found")
-        return QUESTIONS[0]
-
-class FunctionDefinitionAgent:
-    def __init__(self):
-        if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-            logger.warning("OpenAI API key not set. Function definition generation will be limited.")
-        openai.api_key = settings.openai_api_key
-
-    def generate(self, question, language):
-        try:
-            if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-                # Return a basic function stub when OpenAI is not available
-                if language == "python":
-                    return f"def {question.get('title', '').lower().replace(' ', '_')}():\n    pass"
-                elif language == "javascript":
-                    title = question.get('title', '').lower().replace(' ', '')
-                    return f"function {title}() {{\n    // Your code here\n}}"
-                else:
-                    return f"// {language} function stub for {question.get('title', '')}"
-            
-            q_title = question.get("title", "")
-            q_desc = question.get("description", "")
-            
-            prompt = f"""
+# Prompt templates, filled in per request with str.format
+FUNCTION_DEFINITION_PROMPT = """
 Based on the coding question below, generate a function definition for the language "{language}".
 
 Question Title: {q_title}
@@ -169,42 +525,9 @@ class Solution {{
     }}
 }}
 """
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "system", "content": f"You are a code generator. You output only raw code for the {language} language."},
-                          {"role": "user", "content": prompt}],
-                max_tokens=150,
-                temperature=0.0
-            )
-            return response['choices'][0]['message']['content'].strip()
-        except Exception as e:
-            logger.error(f"OpenAI API error: {e}")
-            raise OpenAIError(f"Failed to generate function definition: {str(e)}")
-
-class ClarificationAgent:
-    def __init__(self):
-        if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-            logger.warning("OpenAI API key not set. Clarification responses will be limited.")
-        openai.api_key = settings.openai_api_key
-
-    def respond(self, user_input, question):
-        try:
-            if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-                return "I'm here to help clarify the problem. What specific aspect would you like me to explain further?"
-            
-            q_title = question.get("title", "")
-            q_desc = question.get("description", "")
-            q_examples = "\n".join([f"Input: {ex['input']} | Output: {ex['output']}" for ex in question.get("examples", [])])
-            q_constraints = "\n".join(question.get("constraints", []))
-            
-            prompt = f"""
-You are an expert coding interview coach. The user is asking clarifying questions about a specific coding problem. Your role is to provide targeted, helpful guidance based on their specific question and the problem requirements.
 
-PROBLEM DETAILS:
-Title: {q_title}
-Description: {q_desc}
-Examples: {q_examples}
-Constraints: {q_constraints}
+CLARIFICATION_PROMPT = """
+The user is asking clarifying questions about the problem. Your role is to provide targeted, helpful guidance based on their specific question and the problem requirements.
 
 USER'S QUESTION: {user_input}
 
@@ -217,46 +540,13 @@ ANALYZE their question and provide feedback that:
 
 IMPORTANT: Be specific to this problem. Don't give generic advice. If they're asking about edge cases, mention the actual constraints. If they're confused about the output format, reference the examples.
 """
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "system", "content": "You are a precise coding interview coach who provides problem-specific guidance."},
-                          {"role": "user", "content": prompt}],
-                max_tokens=150,
-                temperature=0.2
-            )
-            return response['choices'][0]['message']['content']
-        except Exception as e:
-            logger.error(f"OpenAI API error: {e}")
-            raise OpenAIError(f"Failed to generate clarification response: {str(e)}")
-
-class BruteForceAgent:
-    def __init__(self):
-        if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-            logger.warning("OpenAI API key not set. Brute force feedback will be limited.")
-        openai.api_key = settings.openai_api_key
-
-    def feedback(self, user_idea, question, time_complexity=None, space_complexity=None):
-        try:
-            if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-                return "That's a good starting approach. Have you considered edge cases and the time complexity of your solution?"
-            
-            q_title = question.get("title", "")
-            q_desc = question.get("description", "")
-            q_examples = "\n".join([f"Input: {ex['input']} | Output: {ex['output']}" for ex in question.get("examples", [])])
-            q_constraints = "\n".join(question.get("constraints", []))
-            
-            prompt = f"""
-You are an expert coding interview coach evaluating a brute-force solution for a specific problem. Your job is to assess if their approach is a valid brute force solution, NOT whether it's optimal.
 
-PROBLEM DETAILS:
-Title: {q_title}
-Description: {q_desc}
-Examples: {q_examples}
-Constraints: {q_constraints}
+BRUTE_FORCE_PROMPT = """
+Evaluate the user's brute-force solution for the problem. Your job is to assess if their approach is a valid brute force solution, NOT whether it's optimal.
 
 USER'S BRUTE-FORCE APPROACH: {user_idea}
-Time Complexity: {time_complexity or 'Not provided'}
-Space Complexity: {space_complexity or 'Not provided'}
+Time Complexity: {time_complexity}
+Space Complexity: {space_complexity}
 
 ANALYZE their approach as a BRUTE FORCE solution:
 1. Is their approach a valid brute force solution for THIS problem? (Does it try all possible combinations/iterations?)
@@ -271,46 +561,13 @@ IMPORTANT:
 - Focus on whether their brute force approach would work, even if inefficient
 - If their approach isn't actually brute force, explain why
 """
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "system", "content": "You are a precise coding interview coach who evaluates solutions against specific problem requirements."},
-                          {"role": "user", "content": prompt}],
-                max_tokens=200,
-                temperature=0.2
-            )
-            return response['choices'][0]['message']['content']
-        except Exception as e:
-            logger.error(f"OpenAI API error: {e}")
-            raise OpenAIError(f"Failed to generate brute force feedback: {str(e)}")
-
-class OptimizeAgent:
-    def __init__(self):
-        if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-            logger.warning("OpenAI API key not set. Optimization feedback will be limited.")
-        openai.api_key = settings.openai_api_key
-
-    def feedback(self, user_idea, question, time_complexity=None, space_complexity=None):
-        try:
-            if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-                return "Good optimization attempt! Consider the trade-offs between time and space complexity."
-            
-            q_title = question.get("title", "")
-            q_desc = question.get("description", "")
-            q_examples = "\n".join([f"Input: {ex['input']} | Output: {ex['output']}" for ex in question.get("examples", [])])
-            q_constraints = "\n".join(question.get("constraints", []))
-            
-            prompt = f"""
-You are an expert coding interview coach evaluating an optimization approach for a specific problem. Analyze the user's optimization against the actual problem requirements.
 
-PROBLEM DETAILS:
-Title: {q_title}
-Description: {q_desc}
-Examples: {q_examples}
-Constraints: {q_constraints}
+OPTIMIZE_PROMPT = """
+Evaluate the user's optimization approach for the problem. Analyze their optimization against the actual problem requirements.
 
 USER'S OPTIMIZATION APPROACH: {user_idea}
-Time Complexity: {time_complexity or 'Not provided'}
-Space Complexity: {space_complexity or 'Not provided'}
+Time Complexity: {time_complexity}
+Space Complexity: {space_complexity}
 
 ANALYZE their optimization and provide specific feedback:
 1. Is their optimization actually better than a brute-force approach for THIS problem?
@@ -321,52 +578,9 @@ ANALYZE their optimization and provide specific feedback:
 
 IMPORTANT: Be specific to this problem. Don't give generic optimization advice. If their optimization doesn't make sense for this problem, explain why. If there are better approaches for this specific problem, hint at them without giving away the solution.
 """
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "system", "content": "You are a precise coding interview coach who evaluates optimizations against specific problem requirements."},
-                          {"role": "user", "content": prompt}],
-                max_tokens=200,
-                temperature=0.2
-            )
-            return response['choices'][0]['message']['content']
-        except Exception as e:
-            logger.error(f"OpenAI API error: {e}")
-            raise OpenAIError(f"Failed to generate optimization feedback: {str(e)}")
-
-class CodeReviewAgent:
-    def __init__(self):
-        if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-            logger.warning("OpenAI API key not set. Code review will be limited.")
-        openai.api_key = settings.openai_api_key
-
-    def review(self, clarification, brute_force, code, question, language, bf_time=None, bf_space=None, opt_time=None, opt_space=None):
-        try:
-            if not settings.openai_api_key or settings.openai_api_key == "sk-dummy-key-for-development":
-                return {
-                    "clarification": {"grade": 7, "feedback": "Good clarification attempt"},
-                    "brute_force": {"grade": 7, "feedback": "Reasonable brute force approach"},
-                    "coding": {
-                        "grade": 7, 
-                        "feedback": "Basic implementation provided",
-                        "line_by_line": []
-                    },
-                    "total": 7,
-                    "key_pointers": "Set up OpenAI API key for detailed code review"
-                }
-            
-            q_title = question.get("title", "")
-            q_desc = question.get("description", "")
-            q_examples = "\n".join([f"Input: {ex['input']} | Output: {ex['output']}" for ex in question.get("examples", [])])
-            q_constraints = "\n".join(question.get("constraints", []))
-            
-            prompt = f"""
-You are a senior coding interview coach providing a comprehensive review for a specific problem. Analyze the user's performance against the actual problem requirements.
 
-PROBLEM DETAILS:
-Title: {q_title}
-Description: {q_desc}
-Examples: {q_examples}
-Constraints: {q_constraints}
+CODE_REVIEW_PROMPT = """
+Provide a comprehensive, senior-level review of the user's work on the problem. Analyze their performance against the actual problem requirements.
 
 Programming Language: {language}
 
@@ -391,53 +605,635 @@ PROVIDE A DETAILED REVIEW:
 
 4. Line-by-line analysis: Identify specific lines with issues and provide concrete suggestions for THIS problem
 
-Return a JSON object with this structure:
-{{
-  "clarification": {{"grade": int, "feedback": str}},
-  "brute_force": {{"grade": int, "feedback": str}},
-  "coding": {{
-    "grade": int, 
-    "feedback": str,
-    "line_by_line": [
-      {{"line": int, "issue": str, "suggestion": str}}
-    ]
-  }},
-  "total": int,
-  "key_pointers": str
-}}
+Reply in the review schema: "total" is the overall grade (1-10) and "key_pointers" lists the most important takeaways.
 
 IMPORTANT: Be specific to this problem. Don't give generic feedback. If their code doesn't solve this problem correctly, explain why. If they're missing key aspects of this problem, point them out specifically.
 """
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "system", "content": f"You are a senior coding interview coach providing detailed, problem-specific feedback for {language} code."},
-                          {"role": "user", "content": prompt}],
-                max_tokens=800,
-                temperature=0.2
+
+# System messages for each agent
+FUNCTION_DEFINITION_SYSTEM_PROMPT = "You are a code generator. You output only raw code for the {language} language."
+
+# Multi-task preambles; they go in the user message so the system header stays shared
+BRUTE_FORCE_OPTIMIZE_INSTRUCTIONS = (
+    "You will receive two independent tasks under '### Brute force' and '### Optimization' headers. "
+    "Answer each one on its own, following its instructions, and reply with a JSON object "
+    '{"brute_force": "...", "optimize": "..."} holding the two answers.'
+)
+COMBINED_REVIEW_INSTRUCTIONS = (
+    "You will receive a code review task followed by independent feedback tasks, each under a '### <name>' header. "
+    "Answer each one on its own, following its instructions, and reply with a single JSON object holding all the answers."
+)
+
+def _strict_object(properties):
+    """JSON schema object in the shape structured outputs require: every key present, no extras"""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+_GRADED_STAGE = _strict_object({"grade": {"type": "integer"}, "feedback": {"type": "string"}})
+
+# Structured output schema, so the review always parses into the shape the frontend expects
+CODE_REVIEW_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "code_review",
+        "strict": True,
+        "schema": _strict_object({
+            "clarification": _GRADED_STAGE,
+            "brute_force": _GRADED_STAGE,
+            "coding": _strict_object({
+                "grade": {"type": "integer"},
+                "feedback": {"type": "string"},
+                "line_by_line": {
+                    "type": "array",
+                    "items": _strict_object({
+                        "line": {"type": "integer"},
+                        "issue": {"type": "string"},
+                        "suggestion": {"type": "string"}
+                    })
+                }
+            }),
+            "total": {"type": "integer"},
+            "key_pointers": {"type": "string"}
+        })
+    }
+}
+
+def combined_review_response_format(include_optimize: bool):
+    """Schema for the single-call review: the code review plus the stage feedback strings"""
+    properties = {
+        "review": CODE_REVIEW_RESPONSE_FORMAT["json_schema"]["schema"],
+        "clarification_feedback": {"type": "string"},
+        "brute_force_feedback": {"type": "string"}
+    }
+    if include_optimize:
+        properties["optimize_feedback"] = {"type": "string"}
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "combined_review", "strict": True, "schema": _strict_object(properties)}
+    }
+
+COMBINED_REVIEW_RESPONSE_FORMATS = {
+    include_optimize: combined_review_response_format(include_optimize) for include_optimize in (False, True)
+}
+
+# Agent classes with improved error handling
+class QuestionAgent:
+    def get_question(self, question_id=None):
+        if not QUESTIONS:
+            raise NotFoundError("No questions available")
+        
+        # Unknown ids fall back to the first question
+        return QUESTIONS_BY_ID.get(question_id, DEFAULT_QUESTION)
+
+def dummy_function_stub(question, language):
+    """Basic function stub served when OpenAI is not available"""
+    if language == "python":
+        return f"def {question.get('title', '').lower().replace(' ', '_')}():\n    pass"
+    elif language == "javascript":
+        title = question.get('title', '').lower().replace(' ', '')
+        return f"function {title}() {{\n    // Your code here\n}}"
+    else:
+        return f"// {language} function stub for {question.get('title', '')}"
+
+DUMMY_FUNCTION_STUBS = {
+    (q["id"], language): dummy_function_stub(q, language) for q in QUESTIONS for language in SUPPORTED_LANGUAGES
+} if IS_DUMMY_KEY else {}
+
+class FunctionDefinitionAgent:
+    """Generates function stubs and keeps them in a JSON file so they survive restarts"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.definitions = self._load()
+        self._write_lock = threading.Lock()
+
+    def _load(self):
+        try:
+            return orjson.loads(self.path.read_bytes())
+        except FileNotFoundError:
+            return {}
+        except orjson.JSONDecodeError as e:
+            logger.warning(f"Ignoring unreadable function definitions file: {e}")
+            return {}
+
+    def _write(self, definitions: dict):
+        # A unique temp file per write keeps concurrent workers from clobbering each other's
+        # half-written file; the lock only orders writes within this process
+        with self._write_lock:
+            # Merge with the file so stubs saved by other workers are kept
+            data = orjson.dumps({**self._load(), **definitions})
+            with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix=f".{self.path.name}.", delete=False) as tmp:
+                tmp.write(data)
+            try:
+                os.replace(tmp.name, self.path)
+            except OSError:
+                os.unlink(tmp.name)
+                raise
+
+    async def _save(self):
+        # Snapshot on the loop so the dict is not mutated while the thread writes it
+        try:
+            await asyncio.to_thread(self._write, dict(self.definitions))
+        except OSError as e:
+            # The stubs are still served from memory; persisting them is only a cache
+            logger.warning(f"Failed to save function definitions: {e}")
+
+    async def _complete(self, question, language):
+        prompt = FUNCTION_DEFINITION_PROMPT.format(
+            language=language,
+            q_title=question.get("title", ""),
+            q_desc=question.get("description", "")
+        )
+        response = await create_chat_completion(
+            model=settings.llm_model,
+            messages=[{"role": "system", "content": FUNCTION_DEFINITION_SYSTEM_PROMPT.format(language=language)},
+                      {"role": "user", "content": prompt}],
+            max_tokens=150,
+            temperature=0.0
+        )
+        return response.choices[0].message.content.strip()
+
+    async def _definition(self, question, language):
+        key = f"{question['id']}:{language}"
+        definition = self.definitions.get(key)
+        if definition is None:
+            # Another worker may have written it since this one started
+            self.definitions.update(await asyncio.to_thread(self._load))
+            definition = self.definitions.get(key)
+        if definition is None:
+            definition = await self._complete(question, language)
+            self.definitions[key] = definition
+            await self._save()
+        return definition
+
+    def _try_lock(self):
+        """Take the cross-process precompute lock without waiting; None if another worker holds it"""
+        fd = os.open(self.path.with_suffix(".lock"), os.O_CREAT | os.O_RDWR)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+        return fd
+
+    async def precompute(self, questions, languages):
+        """Generate every missing (question, language) stub and persist them in one write"""
+        # Every worker starts up at once; only the one holding the lock calls the LLM
+        lock = await asyncio.to_thread(self._try_lock)
+        if lock is None:
+            logger.info("Another worker is precomputing function definitions")
+            return
+        try:
+            # Pick up whatever an earlier worker already wrote
+            self.definitions.update(await asyncio.to_thread(self._load))
+            missing = [(q, language) for q in questions for language in languages
+                       if f"{q['id']}:{language}" not in self.definitions]
+            if not missing:
+                return
+            results = await asyncio.gather(
+                *(self._complete(q, language) for q, language in missing),
+                return_exceptions=True
             )
-            import re, json as pyjson
-            content = response['choices'][0]['message']['content']
-            logger.info(f'OpenAI response: {content}')
-            match = re.search(r'\{[\s\S]*\}', content)
-            if match:
-                try:
-                    return pyjson.loads(match.group(0))
-                except Exception:
-                    pass
-            return {"clarification": {}, "brute_force": {}, "coding": {}, "total": None, "key_pointers": content}
+            for (q, language), result in zip(missing, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to precompute {language} stub for question {q['id']}: {result}")
+                else:
+                    self.definitions[f"{q['id']}:{language}"] = result
+            await self._save()
+            logger.info(f"Precomputed {len(missing)} function definitions")
+        finally:
+            # Closing the descriptor releases the flock
+            os.close(lock)
+
+    async def generate(self, question, language):
+        try:
+            if IS_DUMMY_KEY:
+                # Return a basic function stub when OpenAI is not available
+                stub = DUMMY_FUNCTION_STUBS.get((question.get("id"), language))
+                return stub if stub is not None else dummy_function_stub(question, language)
+            
+            # Stubs are generated at temperature 0, so one per question and language is enough
+            return await self._definition(question, language)
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate function definition: {str(e)}")
+
+class ClarificationAgent:
+    fallback_response = "I'm here to help clarify the problem. What specific aspect would you like me to explain further?"
+
+    def _build_request(self, user_input, question):
+        prompt = CLARIFICATION_PROMPT.format(
+            user_input=truncate_tokens(user_input, settings.max_input_tokens)
+        )
+        return {
+            "model": settings.llm_model,
+            "messages": [{"role": "system", "content": get_system_header(question)},
+                         {"role": "user", "content": prompt}],
+            "max_tokens": settings.llm_max_tokens,
+            "temperature": 0.2
+        }
+
+    async def _complete(self, user_input, question):
+        request = self._build_request(user_input, question)
+        if clarification_batcher is not None:
+            try:
+                return await clarification_batcher.submit(request)
+            except Exception as e:
+                logger.warning(f"Batched clarification failed, retrying individually: {e}")
+        response = await create_chat_completion(**request)
+        return response.choices[0].message.content
+
+    async def respond(self, user_input, question):
+        try:
+            if IS_DUMMY_KEY:
+                return self.fallback_response
+            
+            return await cached_feedback(
+                ("ClarificationAgent", question["id"]),
+                user_input,
+                lambda: self._complete(user_input, question)
+            )
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate clarification response: {str(e)}")
+
+    async def stream(self, user_input, question):
+        """Yield the clarification response token by token"""
+        if IS_DUMMY_KEY:
+            yield self.fallback_response
+            return
+        try:
+            async for token in cached_stream(
+                ("ClarificationAgent", question["id"]),
+                user_input,
+                lambda: stream_chat_completion(**self._build_request(user_input, question))
+            ):
+                yield token
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate clarification response: {str(e)}")
+
+class BruteForceAgent:
+    fallback_response = "That's a good starting approach. Have you considered edge cases and the time complexity of your solution?"
+
+    def _build_request(self, user_idea, question, time_complexity=None, space_complexity=None):
+        prompt = BRUTE_FORCE_PROMPT.format(
+            user_idea=truncate_tokens(user_idea, settings.max_input_tokens),
+            time_complexity=time_complexity or 'Not provided',
+            space_complexity=space_complexity or 'Not provided'
+        )
+        return {
+            "model": settings.llm_model,
+            "messages": [{"role": "system", "content": get_system_header(question)},
+                         {"role": "user", "content": prompt}],
+            "max_tokens": settings.llm_max_tokens,
+            "temperature": 0.2
+        }
+
+    async def _complete(self, user_idea, question, time_complexity=None, space_complexity=None):
+        response = await create_chat_completion(
+            **self._build_request(user_idea, question, time_complexity, space_complexity)
+        )
+        return response.choices[0].message.content
+
+    async def feedback(self, user_idea, question, time_complexity=None, space_complexity=None):
+        try:
+            if IS_DUMMY_KEY:
+                return self.fallback_response
+            
+            return await cached_feedback(
+                ("BruteForceAgent", question["id"], time_complexity, space_complexity),
+                user_idea,
+                lambda: self._complete(user_idea, question, time_complexity, space_complexity)
+            )
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate brute force feedback: {str(e)}")
+
+    async def stream(self, user_idea, question, time_complexity=None, space_complexity=None):
+        """Yield the brute force feedback token by token"""
+        if IS_DUMMY_KEY:
+            yield self.fallback_response
+            return
+        try:
+            async for token in cached_stream(
+                ("BruteForceAgent", question["id"], time_complexity, space_complexity),
+                user_idea,
+                lambda: stream_chat_completion(**self._build_request(user_idea, question, time_complexity, space_complexity))
+            ):
+                yield token
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate brute force feedback: {str(e)}")
+
+class OptimizeAgent:
+    fallback_response = "Good optimization attempt! Consider the trade-offs between time and space complexity."
+
+    def _build_request(self, user_idea, question, time_complexity=None, space_complexity=None):
+        prompt = OPTIMIZE_PROMPT.format(
+            user_idea=truncate_tokens(user_idea, settings.max_input_tokens),
+            time_complexity=time_complexity or 'Not provided',
+            space_complexity=space_complexity or 'Not provided'
+        )
+        return {
+            "model": settings.llm_model,
+            "messages": [{"role": "system", "content": get_system_header(question)},
+                         {"role": "user", "content": prompt}],
+            "max_tokens": settings.llm_max_tokens,
+            "temperature": 0.2
+        }
+
+    async def _complete(self, user_idea, question, time_complexity=None, space_complexity=None):
+        response = await create_chat_completion(
+            **self._build_request(user_idea, question, time_complexity, space_complexity)
+        )
+        return response.choices[0].message.content
+
+    async def feedback(self, user_idea, question, time_complexity=None, space_complexity=None):
+        try:
+            if IS_DUMMY_KEY:
+                return self.fallback_response
+            
+            return await cached_feedback(
+                ("OptimizeAgent", question["id"], time_complexity, space_complexity),
+                user_idea,
+                lambda: self._complete(user_idea, question, time_complexity, space_complexity)
+            )
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate optimization feedback: {str(e)}")
+
+    async def stream(self, user_idea, question, time_complexity=None, space_complexity=None):
+        """Yield the optimization feedback token by token"""
+        if IS_DUMMY_KEY:
+            yield self.fallback_response
+            return
+        try:
+            async for token in cached_stream(
+                ("OptimizeAgent", question["id"], time_complexity, space_complexity),
+                user_idea,
+                lambda: stream_chat_completion(**self._build_request(user_idea, question, time_complexity, space_complexity))
+            ):
+                yield token
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate optimization feedback: {str(e)}")
+
+class BruteForceOptimizeAgent:
+    """Evaluate the brute force and optimized ideas of a session with a single completion"""
+
+    def __init__(self, brute_force_agent: BruteForceAgent, optimize_agent: OptimizeAgent):
+        self.brute_force_agent = brute_force_agent
+        self.optimize_agent = optimize_agent
+
+    async def _complete(self, question, bf_idea, bf_time, bf_space, opt_idea, opt_time, opt_space):
+        bf_request = self.brute_force_agent._build_request(bf_idea, question, bf_time, bf_space)
+        opt_request = self.optimize_agent._build_request(opt_idea, question, opt_time, opt_space)
+        prompt = (
+            f"{BRUTE_FORCE_OPTIMIZE_INSTRUCTIONS}\n\n"
+            f"### Brute force\n{bf_request['messages'][-1]['content']}\n\n"
+            f"### Optimization\n{opt_request['messages'][-1]['content']}"
+        )
+        response = await create_chat_completion(
+            model=bf_request["model"],
+            messages=[bf_request["messages"][0],
+                      {"role": "user", "content": prompt}],
+            max_tokens=bf_request["max_tokens"] + opt_request["max_tokens"],
+            temperature=bf_request["temperature"],
+            response_format={"type": "json_object"}
+        )
+        data = orjson.loads(response.choices[0].message.content)
+        if not isinstance(data.get("brute_force"), str) or not isinstance(data.get("optimize"), str):
+            raise ValueError("Malformed combined feedback response")
+        return data["brute_force"], data["optimize"]
+
+    async def feedback(self, question, bf_idea, bf_time, bf_space, opt_idea, opt_time, opt_space):
+        """Return the (brute force, optimize) feedback pair"""
+        try:
+            if IS_DUMMY_KEY:
+                return self.brute_force_agent.fallback_response, self.optimize_agent.fallback_response
+            
+            return await response_cache.get_or_set(
+                ("BruteForceOptimizeAgent", question["id"], bf_idea, bf_time, bf_space, opt_idea, opt_time, opt_space),
+                lambda: self._complete(question, bf_idea, bf_time, bf_space, opt_idea, opt_time, opt_space)
+            )
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate brute force and optimization feedback: {str(e)}")
+
+class InvalidReviewError(Exception):
+    """A review reply that does not match the review schema; never cached"""
+
+    def __init__(self, content):
+        super().__init__("Code review did not match the review schema")
+        self.content = content
+
+class CodeReviewAgent:
+    fallback_review = {
+        "clarification": {"grade": 7, "feedback": "Good clarification attempt"},
+        "brute_force": {"grade": 7, "feedback": "Reasonable brute force approach"},
+        "coding": {
+            "grade": 7, 
+            "feedback": "Basic implementation provided",
+            "line_by_line": []
+        },
+        "total": 7,
+        "key_pointers": "Set up OpenAI API key for detailed code review"
+    }
+
+    @staticmethod
+    def invalid_review(content):
+        """Review shown for a reply that did not match the schema: empty grades and the raw text"""
+        return {"clarification": {}, "brute_force": {}, "coding": {}, "total": None, "key_pointers": content}
+
+    def _build_request(self, clarification, brute_force, code, question, language, bf_time=None, bf_space=None, opt_time=None, opt_space=None):
+        prompt = CODE_REVIEW_PROMPT.format(
+            language=language,
+            clarification=truncate_tokens(clarification, settings.max_input_tokens),
+            brute_force=truncate_tokens(brute_force, settings.max_input_tokens),
+            code=truncate_tokens(code, settings.max_code_tokens),
+            bf_time=bf_time,
+            bf_space=bf_space,
+            opt_time=opt_time,
+            opt_space=opt_space
+        )
+        return {
+            "model": settings.review_model,
+            "messages": [{"role": "system", "content": get_system_header(question)},
+                         {"role": "user", "content": prompt}],
+            "max_tokens": settings.review_max_tokens,
+            "temperature": 0.2,
+            "response_format": CODE_REVIEW_RESPONSE_FORMAT
+        }
+
+    @staticmethod
+    def _cache_key(clarification, brute_force, code, question, language, bf_time, bf_space, opt_time, opt_space):
+        return ("CodeReviewAgent", question["id"], language, clarification, brute_force, code,
+                bf_time, bf_space, opt_time, opt_space)
+
+    async def _complete(self, *args):
+        response = await create_chat_completion(**self._build_request(*args))
+        content = response.choices[0].message.content
+        logger.debug("OpenAI response: %s", content)
+        try:
+            return ReviewResponse.model_validate_json(content).model_dump()
+        except PydanticValidationError:
+            # Structured outputs only guarantee the schema when the reply is not cut off at max_tokens
+            logger.warning(f"Code review truncated (finish_reason={response.choices[0].finish_reason})")
+            raise InvalidReviewError(content)
+
+    async def review(self, clarification, brute_force, code, question, language, bf_time=None, bf_space=None, opt_time=None, opt_space=None):
+        args = (clarification, brute_force, code, question, language, bf_time, bf_space, opt_time, opt_space)
+        try:
+            if IS_DUMMY_KEY:
+                return self.fallback_review
+            
+            return await response_cache.get_or_set(self._cache_key(*args), lambda: self._complete(*args))
+        except InvalidReviewError as e:
+            # Raised inside get_or_set so the raw reply is shown once but never cached
+            return self.invalid_review(e.content)
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate code review: {str(e)}")
+
+    async def stream(self, clarification, brute_force, code, question, language, bf_time=None, bf_space=None, opt_time=None, opt_space=None):
+        """Yield the review JSON token by token, caching the parsed review once it is complete"""
+        args = (clarification, brute_force, code, question, language, bf_time, bf_space, opt_time, opt_space)
+        if IS_DUMMY_KEY:
+            yield orjson.dumps(self.fallback_review).decode()
+            return
+        key = self._cache_key(*args)
+        cached = response_cache.get(key)
+        if cached is not None:
+            yield orjson.dumps(cached).decode()
+            return
+        parts = []
+        try:
+            async for token in stream_chat_completion(**self._build_request(*args)):
+                parts.append(token)
+                yield token
         except Exception as e:
             logger.error(f"OpenAI API error: {e}")
             raise OpenAIError(f"Failed to generate code review: {str(e)}")
+        content = "".join(parts)
+        logger.debug("OpenAI response: %s", content)
+        try:
+            response_cache.set(key, ReviewResponse.model_validate_json(content).model_dump())
+        except PydanticValidationError:
+            logger.warning("Streamed code review did not match the review schema; not caching it")
+
+class CombinedReviewAgent:
+    """Produce the code review and every stage's feedback with a single completion"""
+
+    def __init__(self, reviewer: CodeReviewAgent, clarifier: ClarificationAgent,
+                 brute_force_agent: BruteForceAgent, optimize_agent: OptimizeAgent):
+        self.reviewer = reviewer
+        self.clarifier = clarifier
+        self.brute_force_agent = brute_force_agent
+        self.optimize_agent = optimize_agent
+
+    async def _complete(self, clarification, brute_force, code, question, language,
+                        bf_time, bf_space, opt_time, opt_space, optimization):
+        review_request = self.reviewer._build_request(
+            clarification, brute_force, code, question, language, bf_time, bf_space, opt_time, opt_space
+        )
+        sections = [
+            COMBINED_REVIEW_INSTRUCTIONS,
+            f"### Code review\n{review_request['messages'][-1]['content']}",
+            "### Clarification feedback\n" + CLARIFICATION_PROMPT.format(
+                user_input=truncate_tokens(clarification, settings.max_input_tokens)
+            ),
+            "### Brute force feedback\n" + BRUTE_FORCE_PROMPT.format(
+                user_idea=truncate_tokens(brute_force, settings.max_input_tokens),
+                time_complexity=bf_time or 'Not provided',
+                space_complexity=bf_space or 'Not provided'
+            )
+        ]
+        if optimization:
+            sections.append("### Optimize feedback\n" + OPTIMIZE_PROMPT.format(
+                user_idea=truncate_tokens(optimization, settings.max_input_tokens),
+                time_complexity=opt_time or 'Not provided',
+                space_complexity=opt_space or 'Not provided'
+            ))
+        response = await create_chat_completion(
+            model=settings.review_model,
+            messages=[review_request["messages"][0],
+                      {"role": "user", "content": "\n\n".join(sections)}],
+            max_tokens=settings.review_max_tokens + settings.llm_max_tokens * (len(sections) - 2),
+            temperature=0.2,
+            response_format=COMBINED_REVIEW_RESPONSE_FORMATS[bool(optimization)]
+        )
+        content = response.choices[0].message.content
+        try:
+            result = CombinedReviewResponse.model_validate_json(content)
+        except PydanticValidationError:
+            # The stage feedback shares the review's budget, so a cut-off reply is more likely here
+            logger.warning(f"Combined review truncated (finish_reason={response.choices[0].finish_reason})")
+            raise InvalidReviewError(content)
+        return (result.review.model_dump(), result.clarification_feedback,
+                result.brute_force_feedback, result.optimize_feedback)
+
+    async def review(self, clarification, brute_force, code, question, language,
+                     bf_time=None, bf_space=None, opt_time=None, opt_space=None, optimization=None):
+        """Return (review, clarification feedback, brute force feedback, optimize feedback)"""
+        args = (clarification, brute_force, code, question, language, bf_time, bf_space, opt_time, opt_space, optimization)
+        try:
+            if IS_DUMMY_KEY:
+                return (self.reviewer.fallback_review, self.clarifier.fallback_response,
+                        self.brute_force_agent.fallback_response,
+                        self.optimize_agent.fallback_response if optimization else None)
+            
+            return await response_cache.get_or_set(
+                ("CombinedReviewAgent", question["id"], *args[:3], *args[4:]),
+                lambda: self._complete(*args)
+            )
+        except InvalidReviewError as e:
+            # Same uncached fallback as the separate review; no stage feedback could be parsed
+            return self.reviewer.invalid_review(e.content), None, None, None
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            raise OpenAIError(f"Failed to generate combined review: {str(e)}")
 
 # Initialize agents
 question_agent = QuestionAgent()
-function_definition_agent = FunctionDefinitionAgent()
+function_definition_agent = FunctionDefinitionAgent(FUNCTION_DEFINITIONS_PATH)
+
+clarification_agent = ClarificationAgent()
+brute_force_agent = BruteForceAgent()
+optimize_agent = OptimizeAgent()
+brute_force_optimize_agent = BruteForceOptimizeAgent(brute_force_agent, optimize_agent)
+code_review_agent = CodeReviewAgent()
+combined_review_agent = CombinedReviewAgent(code_review_agent, clarification_agent, brute_force_agent, optimize_agent)
+
+# Agent providers: async so FastAPI resolves them on the loop instead of hopping to the threadpool
+async def get_clarification_agent() -> ClarificationAgent:
+    return clarification_agent
+
+async def get_brute_force_agent() -> BruteForceAgent:
+    return brute_force_agent
+
+async def get_optimize_agent() -> OptimizeAgent:
+    return optimize_agent
+
+async def get_brute_force_optimize_agent() -> BruteForceOptimizeAgent:
+    return brute_force_optimize_agent
+
+async def get_code_review_agent() -> CodeReviewAgent:
+    return code_review_agent
+
+async def get_combined_review_agent() -> CombinedReviewAgent:
+    return combined_review_agent
 
 # API Endpoints with proper validation
 @app.get("/api/questions")
 async def get_questions():
     """Get all available questions"""
-    return [{"id": q["id"], "title": q["title"]} for q in QUESTIONS]
+    return Response(content=QUESTIONS_PAYLOAD, media_type="application/json")
 
 @app.post("/api/start-session")
 async def start_session(request: StartSessionRequest):
@@ -453,27 +1249,27 @@ async def get_function_definition(request: FunctionDefinitionRequest):
     """Get function definition for a specific language"""
     try:
         question = question_agent.get_question(request.question_id)
-        function_definition = function_definition_agent.generate(question, request.language)
+        function_definition = await function_definition_agent.generate(question, request.language)
         return FunctionDefinitionResponse(function_definition=function_definition)
     except (NotFoundError, OpenAIError) as e:
         raise HTTPException(status_code=e.status_code, detail=str(e))
 
 @app.post("/api/clarify")
-async def clarify(request: ClarifyRequest):
+async def clarify(request: ClarifyRequest, clarifier: ClarificationAgent = Depends(get_clarification_agent)):
     """Get clarification feedback"""
     try:
         question = question_agent.get_question(request.question_id)
-        response = ClarificationAgent().respond(request.user_input, question)
+        response = await clarifier.respond(request.user_input, question)
         return ClarifyResponse(agent="ClarificationAgent", response=response)
     except (NotFoundError, OpenAIError) as e:
         raise HTTPException(status_code=e.status_code, detail=str(e))
 
 @app.post("/api/brute-force")
-async def brute_force(request: BruteForceRequest):
+async def brute_force(request: BruteForceRequest, brute_force_agent: BruteForceAgent = Depends(get_brute_force_agent)):
     """Get brute force solution feedback"""
     try:
         question = question_agent.get_question(request.question_id)
-        response = BruteForceAgent().feedback(
+        response = await brute_force_agent.feedback(
             request.user_idea,
             question,
             request.time_complexity,
@@ -484,11 +1280,11 @@ async def brute_force(request: BruteForceRequest):
         raise HTTPException(status_code=e.status_code, detail=str(e))
 
 @app.post("/api/optimize")
-async def optimize(request: OptimizeRequest):
+async def optimize(request: OptimizeRequest, optimize_agent: OptimizeAgent = Depends(get_optimize_agent)):
     """Get optimization feedback"""
     try:
         question = question_agent.get_question(request.question_id)
-        response = OptimizeAgent().feedback(
+        response = await optimize_agent.feedback(
             request.user_idea,
             question,
             request.time_complexity,
@@ -498,12 +1294,150 @@ async def optimize(request: OptimizeRequest):
     except (NotFoundError, OpenAIError) as e:
         raise HTTPException(status_code=e.status_code, detail=str(e))
 
+@app.post("/api/brute-force-and-optimize")
+async def brute_force_and_optimize(request: BruteForceOptimizeRequest,
+                                   agent: BruteForceOptimizeAgent = Depends(get_brute_force_optimize_agent)):
+    """Get brute force and optimization feedback from one OpenAI request"""
+    try:
+        question = question_agent.get_question(request.question_id)
+        brute_force_feedback, optimize_feedback = await agent.feedback(
+            question,
+            request.brute_force_idea,
+            request.brute_force_time_complexity,
+            request.brute_force_space_complexity,
+            request.optimize_idea,
+            request.optimize_time_complexity,
+            request.optimize_space_complexity
+        )
+        return BruteForceOptimizeResponse(
+            agent="BruteForceOptimizeAgent",
+            brute_force_feedback=brute_force_feedback,
+            optimize_feedback=optimize_feedback
+        )
+    except (NotFoundError, OpenAIError) as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.post("/api/session-feedback")
+async def session_feedback(request: SessionFeedbackRequest,
+                           clarifier: ClarificationAgent = Depends(get_clarification_agent),
+                           brute_force_agent: BruteForceAgent = Depends(get_brute_force_agent),
+                           optimize_agent: OptimizeAgent = Depends(get_optimize_agent)):
+    """Get clarification, brute force and optimization feedback in one request"""
+    try:
+        question = question_agent.get_question(request.question_id)
+        # The three stages are independent, so the wall time is that of the slowest call
+        clarification_feedback, brute_force_feedback, optimize_feedback = await asyncio.gather(
+            clarifier.respond(request.clarification, question),
+            brute_force_agent.feedback(
+                request.brute_force_idea,
+                question,
+                request.brute_force_time_complexity,
+                request.brute_force_space_complexity
+            ),
+            optimize_agent.feedback(
+                request.optimize_idea,
+                question,
+                request.optimize_time_complexity,
+                request.optimize_space_complexity
+            )
+        )
+        return SessionFeedbackResponse(
+            clarification_feedback=clarification_feedback,
+            brute_force_feedback=brute_force_feedback,
+            optimize_feedback=optimize_feedback
+        )
+    except (NotFoundError, OpenAIError) as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.post("/api/clarify/stream")
+async def clarify_stream(request: ClarifyRequest, clarifier: ClarificationAgent = Depends(get_clarification_agent)):
+    """Stream clarification feedback as Server-Sent Events"""
+    try:
+        question = question_agent.get_question(request.question_id)
+    except NotFoundError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return sse_response(clarifier.stream(request.user_input, question))
+
+@app.post("/api/brute-force/stream")
+async def brute_force_stream(request: BruteForceRequest, brute_force_agent: BruteForceAgent = Depends(get_brute_force_agent)):
+    """Stream brute force solution feedback as Server-Sent Events"""
+    try:
+        question = question_agent.get_question(request.question_id)
+    except NotFoundError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return sse_response(brute_force_agent.stream(
+        request.user_idea,
+        question,
+        request.time_complexity,
+        request.space_complexity
+    ))
+
+@app.post("/api/optimize/stream")
+async def optimize_stream(request: OptimizeRequest, optimize_agent: OptimizeAgent = Depends(get_optimize_agent)):
+    """Stream optimization feedback as Server-Sent Events"""
+    try:
+        question = question_agent.get_question(request.question_id)
+    except NotFoundError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return sse_response(optimize_agent.stream(
+        request.user_idea,
+        question,
+        request.time_complexity,
+        request.space_complexity
+    ))
+
+@app.post("/api/code-review/stream")
+async def code_review_stream(request: CodeReviewRequest, reviewer: CodeReviewAgent = Depends(get_code_review_agent)):
+    """Stream the code review JSON as Server-Sent Events"""
+    try:
+        question = question_agent.get_question(request.question_id)
+    except NotFoundError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return sse_response(reviewer.stream(
+        request.clarification,
+        request.brute_force,
+        request.code,
+        question,
+        request.language,
+        request.brute_force_time_complexity,
+        request.brute_force_space_complexity,
+        request.optimize_time_complexity,
+        request.optimize_space_complexity
+    ))
+
 @app.post("/api/code-review")
-async def code_review(request: CodeReviewRequest):
+async def code_review(request: CodeReviewRequest,
+                      reviewer: CodeReviewAgent = Depends(get_code_review_agent),
+                      clarifier: ClarificationAgent = Depends(get_clarification_agent),
+                      brute_force_agent: BruteForceAgent = Depends(get_brute_force_agent),
+                      optimize_agent: OptimizeAgent = Depends(get_optimize_agent),
+                      combined_reviewer: CombinedReviewAgent = Depends(get_combined_review_agent)):
     """Get comprehensive code review"""
     try:
         question = question_agent.get_question(request.question_id)
-        review = CodeReviewAgent().review(
+        if request.include_stage_feedback and settings.combine_review_calls:
+            # One request for everything: fewer RPM slots and one shared prompt prefix
+            review, clarification_feedback, brute_force_feedback, optimize_feedback = await combined_reviewer.review(
+                request.clarification,
+                request.brute_force,
+                request.code,
+                question,
+                request.language,
+                request.brute_force_time_complexity,
+                request.brute_force_space_complexity,
+                request.optimize_time_complexity,
+                request.optimize_space_complexity,
+                request.optimization
+            )
+            return CodeReviewResponse(
+                agent="CodeReviewAgent",
+                review=review,
+                clarification_feedback=clarification_feedback,
+                brute_force_feedback=brute_force_feedback,
+                optimize_feedback=optimize_feedback
+            )
+        
+        review_call = reviewer.review(
             request.clarification,
             request.brute_force,
             request.code,
@@ -514,54 +1448,112 @@ async def code_review(request: CodeReviewRequest):
             request.optimize_time_complexity,
             request.optimize_space_complexity
         )
-        return CodeReviewResponse(agent="CodeReviewAgent", review=review)
+        if not request.include_stage_feedback:
+            return CodeReviewResponse(agent="CodeReviewAgent", review=await review_call)
+        
+        # The stage feedback calls are independent of the review, so run them concurrently
+        calls = [
+            review_call,
+            clarifier.respond(request.clarification, question),
+            brute_force_agent.feedback(
+                request.brute_force,
+                question,
+                request.brute_force_time_complexity,
+                request.brute_force_space_complexity
+            )
+        ]
+        if request.optimization:
+            calls.append(optimize_agent.feedback(
+                request.optimization,
+                question,
+                request.optimize_time_complexity,
+                request.optimize_space_complexity
+            ))
+        review, clarification_feedback, brute_force_feedback, *rest = await asyncio.gather(*calls)
+        return CodeReviewResponse(
+            agent="CodeReviewAgent",
+            review=review,
+            clarification_feedback=clarification_feedback,
+            brute_force_feedback=brute_force_feedback,
+            optimize_feedback=rest[0] if rest else None
+        )
     except (NotFoundError, OpenAIError) as e:
         raise HTTPException(status_code=e.status_code, detail=str(e))
 
 # User management endpoints (basic implementation)
 @app.post("/api/register")
-async def register(request: Request, db: Session = Depends(get_db)):
+async def register(request: Request, db: AsyncSession = Depends(get_db)):
     """Register a new user"""
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         username = data.get("username")
         email = data.get("email")
         password = data.get("password")
         
-        if db.query(User).filter((User.username == username) | (User.email == email)).first():
-            raise HTTPException(status_code=400, detail="Username or email already registered")
-        
         user = User(
             username=username,
             email=email,
-            hashed_password=get_password_hash(password)
+            hashed_password=await asyncio.to_thread(get_password_hash, password)
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        # The unique indexes on username and email reject duplicates, so no lookup is needed first
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            raise HTTPException(status_code=400, detail="Username or email already registered")
         return {"msg": "User registered successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Registration error: {e}")
         raise HTTPException(status_code=500, detail="Registration failed")
 
 @app.post("/api/login")
-async def login(request: Request, db: Session = Depends(get_db)):
+async def login(request: Request, db: AsyncSession = Depends(get_db)):
     """Login user"""
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         username = data.get("username")
         password = data.get("password")
         
-        user = db.query(User).filter(User.username == username).first()
-        if not user or not verify_password(password, user.hashed_password):
+        # Only the columns the check needs, without loading a full User into the session
+        user = (await db.execute(
+            select(User.id, User.username, User.hashed_password).where(User.username == username).limit(1)
+        )).first()
+        
+        password = password or ""
+        cache_key = login_cache_key(user.username, password, user.hashed_password) if user else None
+        if cache_key is not None and cache_key in verified_logins:
+            valid, new_hash = True, None
+        else:
+            # Hashing is deliberately CPU-heavy; keep it off the event loop
+            valid, new_hash = await asyncio.to_thread(
+                pwd_context.verify_and_update, password,
+                user.hashed_password if user else DUMMY_PASSWORD_HASH
+            )
+        if not user or not valid:
             raise HTTPException(status_code=401, detail="Invalid credentials")
+        if new_hash:
+            await db.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+            await db.commit()
+            cache_key = login_cache_key(user.username, password, new_hash)
+        verified_logins[cache_key] = True
         
         access_token = create_access_token(data={"sub": user.username})
         return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Login error: {e}")
         raise HTTPException(status_code=500, detail="Login failed")
 
+# Only consumer of get_current_user: lets the client validate a stored token
+@app.get("/api/me", response_model=UserResponse)
+async def read_current_user(current_user: User = Depends(get_current_user)):
+    """Get the authenticated user"""
+    return current_user
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
@@ -569,5 +1561,9 @@ if __name__ == "__main__":
         host=settings.host,
         port=settings.port,
         reload=settings.debug,
+        # The reloader only supports a single process
+        workers=WORKER_COUNT,
+        # LoggingMiddleware already logs every request; the access log only doubles the work
+        access_log=settings.debug,
         log_level=settings.log_level.lower()
     ) 
\ No newline at end of file
@@ -1,43 +1,102 @@
 import time
-from typing import Dict, List
+from typing import Optional, Tuple
 from fastapi import Request, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from collections import defaultdict
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from collections import deque
 import logging
+import redis.asyncio as redis
+from cachetools import TTLCache
+from redis.exceptions import RedisError
 from config import settings
 
 logger = logging.getLogger(__name__)
 
-# In-memory rate limiting (use Redis in production)
-rate_limit_store: Dict[str, List[float]] = defaultdict(list)
+# In-memory rate limiting, used when no Redis is configured. Bounded, and idle IPs
+# expire once their window is long past, so unique source addresses cannot grow it forever
+RATE_LIMIT_WINDOW_SECONDS = 60
+rate_limit_store: TTLCache = TTLCache(
+    maxsize=settings.rate_limit_max_ips, ttl=RATE_LIMIT_WINDOW_SECONDS * 2
+)
 
+# Count a hit in the current window and start the window's expiry on its first hit,
+# atomically, so concurrent workers never lose an increment or leave a key without a TTL
+RATE_LIMIT_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return count
+"""
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
+
+# Probe endpoints bypass the custom middlewares: liveness checks every few seconds should
+# not spend rate-limit slots, fill the request log or pay for header rewriting
+BYPASS_PATHS = frozenset({"/health"})
+
+# The custom middlewares are plain ASGI callables rather than BaseHTTPMiddleware, which
+# wraps every request in an extra task group and Request/Response round trip and relays
+# streamed bodies (the SSE endpoints) through an in-memory stream
+class RateLimitMiddleware:
     """Rate limiting middleware"""
     
-    def __init__(self, app, requests_per_minute: int = 60):
-        super().__init__(app)
+    def __init__(self, app: ASGIApp, requests_per_minute: int = 60, redis_client: Optional[redis.Redis] = None):
+        self.app = app
         self.requests_per_minute = requests_per_minute
-        self.window_size = 60  # 1 minute window
+        self.window_size = RATE_LIMIT_WINDOW_SECONDS
+        # The script object runs EVALSHA and reloads the script if Redis has lost it
+        self._increment = redis_client.register_script(RATE_LIMIT_SCRIPT) if redis_client is not None else None
+    
+    def _check_local(self, client_ip: str) -> Tuple[bool, int, int]:
+        """Sliding window over this process's own requests"""
+        # Timestamps are appended in order, so expired ones are always at the head;
+        # the monotonic clock keeps the window immune to wall-clock jumps
+        request_times = rate_limit_store.get(client_ip)
+        if request_times is None:
+            request_times = deque()
+        now = time.monotonic()
+        while request_times and now - request_times[0] >= self.window_size:
+            request_times.popleft()
+        
+        reset = int(time.time() + self.window_size)
+        if len(request_times) >= self.requests_per_minute:
+            return False, 0, reset
+        request_times.append(now)
+        # Re-storing restarts the entry's TTL, so only idle IPs expire
+        rate_limit_store[client_ip] = request_times
+        return True, self.requests_per_minute - len(request_times), reset
+    
+    async def _check_shared(self, client_ip: str) -> Tuple[bool, int, int]:
+        """Fixed window counted in Redis, shared by every worker"""
+        window = int(time.time() // self.window_size)
+        try:
+            count = await self._increment(keys=[f"rl:{client_ip}:{window}"], args=[self.window_size])
+        except RedisError as e:
+            # A per-process limit beats failing every request while Redis is down
+            logger.warning(f"Redis rate limit unavailable, using local window: {e}")
+            return self._check_local(client_ip)
+        return count <= self.requests_per_minute, max(self.requests_per_minute - count, 0), (window + 1) * self.window_size
     
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in BYPASS_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
         # Get client IP
-        client_ip = request.client.host
+        client_ip = scope["client"][0] if scope.get("client") else "unknown"
         
-        # Clean old requests outside the window
-        current_time = time.time()
-        rate_limit_store[client_ip] = [
-            req_time for req_time in rate_limit_store[client_ip]
-            if current_time - req_time < self.window_size
-        ]
+        if self._increment is not None:
+            allowed, remaining, reset = await self._check_shared(client_ip)
+        else:
+            allowed, remaining, reset = self._check_local(client_ip)
         
         # Check if rate limit exceeded
-        if len(rate_limit_store[client_ip]) >= self.requests_per_minute:
+        if not allowed:
             logger.warning(f"Rate limit exceeded for IP: {client_ip}")
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 content={
                     "error": "Rate limit exceeded",
@@ -45,75 +104,94 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
                     "retry_after": 60
                 }
             )
-        
-        # Add current request
-        rate_limit_store[client_ip].append(current_time)
+            await response(scope, receive, send)
+            return
         
         # Add rate limit headers
-        response = await call_next(request)
-        response.headers["X-RateLimit-Limit"] = str(self.requests_per_minute)
-        response.headers["X-RateLimit-Remaining"] = str(
-            self.requests_per_minute - len(rate_limit_store[client_ip])
-        )
-        response.headers["X-RateLimit-Reset"] = str(
-            int(current_time + self.window_size)
-        )
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-RateLimit-Limit"] = str(self.requests_per_minute)
+                headers["X-RateLimit-Remaining"] = str(remaining)
+                headers["X-RateLimit-Reset"] = str(reset)
+            await send(message)
         
-        return response
+        await self.app(scope, receive, send_with_headers)
+
 
+# Security headers
+SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "X-XSS-Protection": "1; mode=block",
+    "Referrer-Policy": "strict-origin-when-cross-origin",
+    "Content-Security-Policy": "default-src 'self'",
+}
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
+
+class SecurityHeadersMiddleware:
     """Add security headers to responses"""
     
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        
-        # Security headers
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        response.headers["Content-Security-Policy"] = "default-src 'self'"
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in BYPASS_PATHS:
+            await self.app(scope, receive, send)
+            return
         
-        # Remove server information
-        if "server" in response.headers:
-            del response.headers["server"]
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.update(SECURITY_HEADERS)
+                
+                # Remove server information
+                if "server" in headers:
+                    del headers["server"]
+            await send(message)
         
-        return response
+        await self.app(scope, receive, send_with_headers)
 
 
-class LoggingMiddleware(BaseHTTPMiddleware):
+class LoggingMiddleware:
     """Log all requests and responses"""
     
-    async def dispatch(self, request: Request, call_next):
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in BYPASS_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        request = Request(scope)
         start_time = time.time()
+        status_code = None
+        
+        # Log request; %-style args are only formatted if INFO is enabled, and the
+        # root QueueHandler hands the record to the listener thread for the write
+        logger.info("Request: %s %s from %s", request.method, request.url,
+                    request.client.host if request.client else "unknown")
         
-        # Log request
-        logger.info(f"Request: {request.method} {request.url} from {request.client.host}")
+        async def send_with_timing(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # Add timing header
+                MutableHeaders(scope=message)["X-Process-Time"] = str(time.time() - start_time)
+            await send(message)
         
         try:
-            response = await call_next(request)
-            
-            # Log response
-            process_time = time.time() - start_time
-            logger.info(
-                f"Response: {response.status_code} - {request.method} {request.url} "
-                f"took {process_time:.3f}s"
-            )
-            
-            # Add timing header
-            response.headers["X-Process-Time"] = str(process_time)
-            
-            return response
-            
+            await self.app(scope, receive, send_with_timing)
         except Exception as e:
             # Log error
             process_time = time.time() - start_time
-            logger.error(
-                f"Error: {str(e)} - {request.method} {request.url} "
-                f"took {process_time:.3f}s"
-            )
+            logger.error("Error: %s - %s %s took %.3fs", e, request.method, request.url, process_time)
             raise
+        
+        # Log response
+        process_time = time.time() - start_time
+        logger.info("Response: %s - %s %s took %.3fs", status_code, request.method, request.url, process_time)
 
 
 def setup_middleware(app):
@@ -127,8 +205,10 @@ def setup_middleware(app):
         CORSMiddleware,
         allow_origins=settings.allowed_origins,
         allow_credentials=True,
-        allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        allow_headers=["*"],
+        allow_methods=["GET", "POST", "OPTIONS"],
+        allow_headers=["Authorization", "Content-Type"],
+        # Let browsers cache preflight results instead of sending OPTIONS before every POST
+        max_age=settings.cors_max_age,
     )
     
     # Trusted host middleware (in production)
@@ -141,4 +221,8 @@ def setup_middleware(app):
     # Custom middleware - add after CORS
     app.add_middleware(SecurityHeadersMiddleware)
     app.add_middleware(LoggingMiddleware)
-    app.add_middleware(RateLimitMiddleware, requests_per_minute=settings.rate_limit_per_minute) 
\ No newline at end of file
+    app.add_middleware(
+        RateLimitMiddleware,
+        requests_per_minute=settings.rate_limit_per_minute,
+        redis_client=redis.from_url(settings.redis_url) if settings.redis_url else None
+    ) 
\ No newline at end of file
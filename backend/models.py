@@ -7,6 +7,8 @@ from datetime import datetime
 
 Base = declarative_base()
 
+SUPPORTED_LANGUAGES = ['javascript', 'python', 'java', 'cpp', 'go']
+
 # Database Models
 class User(Base):
     __tablename__ = "users"
@@ -113,15 +115,57 @@ class OptimizeRequest(BaseModel):
             raise ValueError('Idea must be less than 2000 characters')
         return v.strip()
 
+class BruteForceOptimizeRequest(BaseModel):
+    brute_force_idea: str
+    brute_force_time_complexity: Optional[str] = None
+    brute_force_space_complexity: Optional[str] = None
+    optimize_idea: str
+    optimize_time_complexity: Optional[str] = None
+    optimize_space_complexity: Optional[str] = None
+    question_id: int
+    
+    @validator('brute_force_idea', 'optimize_idea')
+    def idea_must_not_be_empty(cls, v):
+        if not v.strip():
+            raise ValueError('Idea cannot be empty')
+        if len(v) > 2000:
+            raise ValueError('Idea must be less than 2000 characters')
+        return v.strip()
+
+class SessionFeedbackRequest(BaseModel):
+    clarification: str
+    brute_force_idea: str
+    brute_force_time_complexity: Optional[str] = None
+    brute_force_space_complexity: Optional[str] = None
+    optimize_idea: str
+    optimize_time_complexity: Optional[str] = None
+    optimize_space_complexity: Optional[str] = None
+    question_id: int
+    
+    @validator('clarification')
+    def clarification_must_not_be_empty(cls, v):
+        if not v.strip():
+            raise ValueError('Input cannot be empty')
+        if len(v) > 1000:
+            raise ValueError('Input must be less than 1000 characters')
+        return v.strip()
+    
+    @validator('brute_force_idea', 'optimize_idea')
+    def idea_must_not_be_empty(cls, v):
+        if not v.strip():
+            raise ValueError('Idea cannot be empty')
+        if len(v) > 2000:
+            raise ValueError('Idea must be less than 2000 characters')
+        return v.strip()
+
 class FunctionDefinitionRequest(BaseModel):
     question_id: int
     language: str
     
     @validator('language')
     def language_must_be_valid(cls, v):
-        valid_languages = ['javascript', 'python', 'java', 'cpp', 'go']
-        if v not in valid_languages:
-            raise ValueError(f'Language must be one of: {", ".join(valid_languages)}')
+        if v not in SUPPORTED_LANGUAGES:
+            raise ValueError(f'Language must be one of: {", ".join(SUPPORTED_LANGUAGES)}')
         return v
 
 class CodeReviewRequest(BaseModel):
@@ -133,7 +177,9 @@ class CodeReviewRequest(BaseModel):
     brute_force_space_complexity: Optional[str] = None
     optimize_time_complexity: Optional[str] = None
     optimize_space_complexity: Optional[str] = None
+    optimization: Optional[str] = None
     question_id: int
+    include_stage_feedback: bool = False
     
     @validator('code')
     def code_must_not_be_empty(cls, v):
@@ -165,12 +211,50 @@ class OptimizeResponse(BaseModel):
     agent: str
     response: str
 
+class BruteForceOptimizeResponse(BaseModel):
+    agent: str
+    brute_force_feedback: str
+    optimize_feedback: str
+
+class SessionFeedbackResponse(BaseModel):
+    clarification_feedback: str
+    brute_force_feedback: str
+    optimize_feedback: str
+
 class FunctionDefinitionResponse(BaseModel):
     function_definition: str
 
+class StageReview(BaseModel):
+    grade: int
+    feedback: str
+
+class LineComment(BaseModel):
+    line: int
+    issue: str
+    suggestion: str
+
+class CodingReview(StageReview):
+    line_by_line: List[LineComment] = []
+
+class ReviewResponse(BaseModel):
+    clarification: StageReview
+    brute_force: StageReview
+    coding: CodingReview
+    total: int
+    key_pointers: str
+
+class CombinedReviewResponse(BaseModel):
+    review: ReviewResponse
+    clarification_feedback: str
+    brute_force_feedback: str
+    optimize_feedback: Optional[str] = None
+
 class CodeReviewResponse(BaseModel):
     agent: str
     review: dict
+    clarification_feedback: Optional[str] = None
+    brute_force_feedback: Optional[str] = None
+    optimize_feedback: Optional[str] = None
 
 class QuestionResponse(BaseModel):
     id: int
@@ -0,0 +1,26 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Async token bucket holding up to `rate` units, refilled continuously over `period` seconds"""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.capacity = rate
+        self.refill_rate = rate / period
+        self._level = rate
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        """Wait until `amount` units are available and take them"""
+        # Reserve first and sleep off any deficit, so concurrent callers queue in arrival order
+        # without a lock; a single call can never need more than a full bucket
+        self._refill()
+        self._level -= min(amount, self.capacity)
+        if self._level < 0:
+            await asyncio.sleep(-self._level / self.refill_rate)
@@ -57,7 +57,9 @@ def run_migrations():
 def start_gunicorn():
     """Start the application with Gunicorn"""
     # Gunicorn configuration
-    workers = os.getenv("GUNICORN_WORKERS", "4")
+    workers = os.getenv("GUNICORN_WORKERS", os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+    # The app splits its OpenAI rate budgets across WEB_CONCURRENCY processes
+    os.environ["WEB_CONCURRENCY"] = workers
     bind = os.getenv("BIND_ADDRESS", "0.0.0.0:8000")
     timeout = os.getenv("TIMEOUT", "120")
     
@@ -68,7 +70,6 @@ def start_gunicorn():
         "--bind", bind,
         "--timeout", timeout,
         "--worker-class", "uvicorn.workers.UvicornWorker",
-        "--access-logfile", "-",
         "--error-logfile", "-",
         "--log-level", "info"
     ]
@@ -1,15 +1,38 @@
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+# Keep test users out of the development database
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.gettempdir(), 'leetcoach_test.db')}")
+
+import jwt
 import pytest
+import redis.asyncio as redis
 from fastapi.testclient import TestClient
-from main import app
-from models import Base
-from database import engine
-
-# Create test database
-Base.metadata.create_all(bind=engine)
+from config import settings
+from main import (
+    app, pwd_context, count_tokens, truncate_tokens, normalize_text, FunctionDefinitionAgent, CodeReviewAgent,
+    ClarificationAgent, BruteForceAgent, QUESTIONS_BY_ID, create_access_token, principal_cache,
+    select_examples, verified_logins
+)
+from models import ReviewResponse, CombinedReviewResponse
+from batching import MicroBatcher
+from exceptions import OpenAIError
+from middleware import rate_limit_store, RateLimitMiddleware
 
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    """Run the app lifespan so startup creates the database tables"""
+    with client:
+        yield
+
+
 class TestQuestionsAPI:
     """Test questions endpoints"""
     
@@ -69,6 +92,98 @@ class TestFunctionDefinitionAPI:
         assert response.status_code == 422  # Validation error
 
 
+class TestFunctionDefinitionStore:
+    """Test persistence of generated function stubs"""
+    
+    @pytest.mark.asyncio
+    async def test_stubs_are_persisted_and_reloaded(self, tmp_path):
+        """Test that precomputed stubs are written once and served after a restart"""
+        path = tmp_path / "function_defs.json"
+        calls = []
+        
+        async def fake_complete(question, language):
+            calls.append((question["id"], language))
+            return f"stub {question['id']} {language}"
+        
+        agent = FunctionDefinitionAgent(path)
+        agent._complete = fake_complete
+        await agent.precompute([{"id": 1}, {"id": 2}], ["python", "go"])
+        assert len(calls) == 4
+        
+        restarted = FunctionDefinitionAgent(path)
+        restarted._complete = fake_complete
+        assert await restarted._definition({"id": 2}, "go") == "stub 2 go"
+        await restarted.precompute([{"id": 1}, {"id": 2}], ["python", "go"])
+        assert len(calls) == 4
+        # Writes go through unique temp files that are renamed into place
+        assert sorted(tmp_path.iterdir()) == [path, path.with_suffix(".lock")]
+    
+    @pytest.mark.asyncio
+    async def test_precompute_skipped_while_another_worker_holds_lock(self, tmp_path):
+        """Test that only one process generates stubs at startup"""
+        path = tmp_path / "function_defs.json"
+        calls = []
+        
+        async def fake_complete(question, language):
+            calls.append((question["id"], language))
+            return "stub"
+        
+        holder = FunctionDefinitionAgent(path)
+        lock = holder._try_lock()
+        try:
+            agent = FunctionDefinitionAgent(path)
+            agent._complete = fake_complete
+            await agent.precompute([{"id": 1}], ["python"])
+            assert not calls
+        finally:
+            os.close(lock)
+        
+        await agent.precompute([{"id": 1}], ["python"])
+        assert calls == [(1, "python")]
+    
+    @pytest.mark.asyncio
+    async def test_stub_written_by_another_worker_is_reused(self, tmp_path):
+        """Test that a worker re-reads the file on a miss instead of calling the model"""
+        path = tmp_path / "function_defs.json"
+        idle = FunctionDefinitionAgent(path)
+        precomputing = FunctionDefinitionAgent(path)
+        calls = []
+        
+        async def fake_complete(question, language):
+            calls.append((question["id"], language))
+            return "stub"
+        
+        precomputing._complete = fake_complete
+        idle._complete = fake_complete
+        await precomputing.precompute([{"id": 1}], ["python"])
+        assert await idle._definition({"id": 1}, "python") == "stub"
+        assert calls == [(1, "python")]
+    
+    @pytest.mark.asyncio
+    async def test_saves_keep_stubs_written_by_other_workers(self, tmp_path):
+        """Test that a save merges with the file instead of overwriting it"""
+        path = tmp_path / "function_defs.json"
+        first = FunctionDefinitionAgent(path)
+        second = FunctionDefinitionAgent(path)
+        first.definitions["1:python"] = "one"
+        await first._save()
+        second.definitions["2:go"] = "two"
+        await second._save()
+        assert FunctionDefinitionAgent(path).definitions == {"1:python": "one", "2:go": "two"}
+    
+    @pytest.mark.asyncio
+    async def test_save_failure_still_serves_stub(self, tmp_path):
+        """Test that a disk error while persisting does not fail the request"""
+        agent = FunctionDefinitionAgent(tmp_path / "missing" / "function_defs.json")
+        
+        async def fake_complete(question, language):
+            return "stub"
+        
+        agent._complete = fake_complete
+        assert await agent._definition({"id": 1}, "python") == "stub"
+        assert not list(tmp_path.iterdir())
+
+
 class TestClarifyAPI:
     """Test clarify endpoint"""
     
@@ -99,6 +214,100 @@ class TestClarifyAPI:
             "question_id": 1
         })
         assert response.status_code == 422  # Validation error
+    
+    def test_clarify_stream(self):
+        """Test clarify streaming returns Server-Sent Events"""
+        response = client.post("/api/clarify/stream", json={
+            "user_input": "What should I return if there's no solution?",
+            "question_id": 1
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text.startswith("data: ")
+        assert response.text.endswith("data: [DONE]\n\n")
+    
+    @pytest.mark.asyncio
+    async def test_repeated_stream_is_served_from_cache(self, monkeypatch):
+        """Test that a streamed reply is cached and a normalized repeat skips the model"""
+        import main
+        calls = []
+        
+        async def fake_completion(**kwargs):
+            calls.append(kwargs)
+            
+            async def chunks():
+                for text in ("Return ", "an empty ", "list."):
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+            return chunks()
+        
+        monkeypatch.setattr(main, "IS_DUMMY_KEY", False)
+        monkeypatch.setattr(main, "create_chat_completion", fake_completion)
+        agent = ClarificationAgent()
+        user_input = f"What if there is no solution? {uuid.uuid4().hex}"
+        first = [token async for token in agent.stream(user_input, QUESTIONS_BY_ID[1])]
+        assert first == ["Return ", "an empty ", "list."]
+        assert calls[0]["stream"] is True
+        
+        repeat = [token async for token in agent.stream(f"  {user_input.upper()}\n", QUESTIONS_BY_ID[1])]
+        assert repeat == ["Return an empty list."]
+        assert len(calls) == 1
+
+
+class TestClarificationBatching:
+    """Test batching several clarification requests into one completion"""
+    
+    @staticmethod
+    def fake_completion(calls, batch_content, single_content="solo"):
+        async def create(**kwargs):
+            calls.append(kwargs)
+            content = batch_content if "response_format" in kwargs else single_content
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+        return create
+    
+    @pytest.mark.asyncio
+    async def test_batch_prompt_and_responses_round_trip(self, monkeypatch):
+        """Test that each request keeps its own header and gets its own answer back"""
+        import main
+        calls = []
+        monkeypatch.setattr(main, "create_chat_completion", self.fake_completion(calls, '{"responses": ["a", "b"]}'))
+        agent = ClarificationAgent()
+        requests = [agent._build_request("Can it be empty?", QUESTIONS_BY_ID[1]),
+                    agent._build_request("Are values unique?", QUESTIONS_BY_ID[2])]
+        assert await main.complete_clarification_batch(requests) == ["a", "b"]
+        prompt = calls[0]["messages"][1]["content"]
+        assert prompt.index("### Request 0") < prompt.index("Can it be empty?") < prompt.index("### Request 1")
+        assert prompt.index("### Request 1") < prompt.index(QUESTIONS_BY_ID[2]["title"]) < prompt.index("Are values unique?")
+        assert calls[0]["max_tokens"] == sum(request["max_tokens"] for request in requests)
+        assert calls[0]["response_format"] == {"type": "json_object"}
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("content", ['{"responses": "a"}', '{"responses": ["a", 2]}', '{"answers": []}', "not json"])
+    async def test_malformed_batch_response_is_an_error(self, monkeypatch, content):
+        """Test that a reply without a list of strings is rejected"""
+        import main
+        monkeypatch.setattr(main, "create_chat_completion", self.fake_completion([], content))
+        request = ClarificationAgent()._build_request("Can it be empty?", QUESTIONS_BY_ID[1])
+        with pytest.raises(ValueError):
+            await main.complete_clarification_batch([request, request])
+    
+    @pytest.mark.asyncio
+    async def test_failed_batch_retries_each_request_individually(self, monkeypatch):
+        """Test that a batch with the wrong number of answers falls back to one call per caller"""
+        import main
+        calls = []
+        monkeypatch.setattr(main, "create_chat_completion", self.fake_completion(calls, '{"responses": ["only one"]}'))
+        batcher = MicroBatcher(main.complete_clarification_batch, batch_size=2, max_wait=0.05)
+        monkeypatch.setattr(main, "clarification_batcher", batcher)
+        agent = ClarificationAgent()
+        try:
+            results = await asyncio.gather(
+                agent._complete("Can it be empty?", QUESTIONS_BY_ID[1]),
+                agent._complete("Are values unique?", QUESTIONS_BY_ID[1])
+            )
+        finally:
+            await batcher.close()
+        assert results == ["solo", "solo"]
+        assert ["response_format" in kwargs for kwargs in calls] == [True, False, False]
 
 
 class TestBruteForceAPI:
@@ -143,6 +352,90 @@ class TestOptimizeAPI:
         assert "response" in data
 
 
+class TestBruteForceOptimizeAPI:
+    """Test combined brute force and optimization endpoint"""
+    
+    def test_brute_force_and_optimize_valid_input(self):
+        """Test getting both feedbacks in one call"""
+        response = client.post("/api/brute-force-and-optimize", json={
+            "brute_force_idea": "Check every pair of numbers",
+            "brute_force_time_complexity": "O(n^2)",
+            "brute_force_space_complexity": "O(1)",
+            "optimize_idea": "Store seen numbers in a hash map",
+            "optimize_time_complexity": "O(n)",
+            "optimize_space_complexity": "O(n)",
+            "question_id": 1
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["agent"] == "BruteForceOptimizeAgent"
+        assert data["brute_force_feedback"]
+        assert data["optimize_feedback"]
+    
+    def test_brute_force_and_optimize_empty_idea(self):
+        """Test combined feedback with an empty optimization idea"""
+        response = client.post("/api/brute-force-and-optimize", json={
+            "brute_force_idea": "Check every pair of numbers",
+            "optimize_idea": "   ",
+            "question_id": 1
+        })
+        assert response.status_code == 422
+    
+    @staticmethod
+    def agent_replying(monkeypatch, content):
+        import main
+        calls = []
+        
+        async def fake_completion(**kwargs):
+            calls.append(kwargs)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+        
+        monkeypatch.setattr(main, "IS_DUMMY_KEY", False)
+        monkeypatch.setattr(main, "create_chat_completion", fake_completion)
+        return main.BruteForceOptimizeAgent(BruteForceAgent(), main.OptimizeAgent()), calls
+    
+    @pytest.mark.asyncio
+    async def test_combined_reply_is_split_into_both_feedbacks(self, monkeypatch):
+        """Test that one JSON reply yields the brute force and optimize feedback"""
+        agent, calls = self.agent_replying(monkeypatch, '{"brute_force": "Too slow", "optimize": "Use a hash map"}')
+        feedback = await agent.feedback(QUESTIONS_BY_ID[1], f"Check every pair {uuid.uuid4().hex}", "O(n^2)", "O(1)",
+                                        "Store seen numbers", "O(n)", "O(n)")
+        assert feedback == ("Too slow", "Use a hash map")
+        prompt = calls[0]["messages"][1]["content"]
+        assert prompt.index("### Brute force\n") < prompt.index("Check every pair") < prompt.index("### Optimization\n")
+        assert calls[0]["response_format"] == {"type": "json_object"}
+    
+    @pytest.mark.asyncio
+    async def test_combined_reply_missing_a_key_is_an_error(self, monkeypatch):
+        """Test that a reply without both feedback strings fails instead of being cached"""
+        agent, calls = self.agent_replying(monkeypatch, '{"brute_force": "Too slow"}')
+        idea = f"Check every pair {uuid.uuid4().hex}"
+        for _ in range(2):
+            with pytest.raises(OpenAIError, match="Malformed combined feedback response"):
+                await agent.feedback(QUESTIONS_BY_ID[1], idea, None, None, "Store seen numbers", None, None)
+        assert len(calls) == 2
+
+
+class TestSessionFeedbackAPI:
+    """Test combined stage feedback endpoint"""
+    
+    def test_session_feedback_valid_input(self):
+        """Test getting all three stage feedbacks in one call"""
+        response = client.post("/api/session-feedback", json={
+            "clarification": "Can the array contain negative numbers?",
+            "brute_force_idea": "Check every pair of numbers",
+            "brute_force_time_complexity": "O(n^2)",
+            "optimize_idea": "Store seen numbers in a hash map",
+            "optimize_time_complexity": "O(n)",
+            "question_id": 1
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["clarification_feedback"]
+        assert data["brute_force_feedback"]
+        assert data["optimize_feedback"]
+
+
 class TestCodeReviewAPI:
     """Test code review endpoint"""
     
@@ -159,6 +452,130 @@ class TestCodeReviewAPI:
         data = response.json()
         assert "agent" in data
         assert "review" in data
+        assert data["clarification_feedback"] is None
+    
+    def test_code_review_with_stage_feedback(self):
+        """Test code review returning clarification and brute force feedback"""
+        response = client.post("/api/code-review", json={
+            "clarification": "I need to find two numbers that sum to target",
+            "brute_force": "Use nested loops to check all pairs",
+            "code": "def twoSum(nums, target):\n    pass",
+            "language": "python",
+            "question_id": 1,
+            "include_stage_feedback": True
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert "review" in data
+        assert data["clarification_feedback"]
+        assert data["brute_force_feedback"]
+        assert data["optimize_feedback"] is None
+    
+    def test_code_review_with_optimize_feedback(self):
+        """Test code review also returning optimization feedback when an idea is given"""
+        response = client.post("/api/code-review", json={
+            "clarification": "I need to find two numbers that sum to target",
+            "brute_force": "Use nested loops to check all pairs",
+            "optimization": "Store seen numbers in a hash map",
+            "code": "def twoSum(nums, target):\n    pass",
+            "language": "python",
+            "question_id": 1,
+            "include_stage_feedback": True
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["clarification_feedback"]
+        assert data["brute_force_feedback"]
+        assert data["optimize_feedback"]
+    
+    def test_code_review_combined_call(self, monkeypatch):
+        """Test code review with stage feedback produced by the single combined call"""
+        monkeypatch.setattr(settings, "combine_review_calls", True)
+        response = client.post("/api/code-review", json={
+            "clarification": "I need to find two numbers that sum to target",
+            "brute_force": "Use nested loops to check all pairs",
+            "optimization": "Store seen numbers in a hash map",
+            "code": "def twoSum(nums, target):\n    pass",
+            "language": "python",
+            "question_id": 1,
+            "include_stage_feedback": True
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["review"]["total"] is not None
+        assert data["clarification_feedback"]
+        assert data["brute_force_feedback"]
+        assert data["optimize_feedback"]
+    
+    def test_combined_review_schema(self):
+        """Test that combined review JSON nests the review next to the stage feedback"""
+        result = CombinedReviewResponse.model_validate({
+            "review": CodeReviewAgent.fallback_review,
+            "clarification_feedback": "Good questions.",
+            "brute_force_feedback": "Correct approach."
+        })
+        assert result.optimize_feedback is None
+    
+    def test_code_review_stream(self):
+        """Test code review streaming returns the review JSON as Server-Sent Events"""
+        response = client.post("/api/code-review/stream", json={
+            "clarification": "I need to find two numbers that sum to target",
+            "brute_force": "Use nested loops to check all pairs",
+            "code": "def twoSum(nums, target):\n    pass",
+            "language": "python",
+            "question_id": 1
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text.startswith("data: {")
+        assert response.text.endswith("data: [DONE]\n\n")
+    
+    @pytest.mark.asyncio
+    async def test_malformed_review_is_not_cached(self, monkeypatch):
+        """Test that a review failing schema validation reaches the model again on resubmission"""
+        import main
+        calls = []
+        
+        async def fake_completion(**kwargs):
+            calls.append(kwargs)
+            message = SimpleNamespace(content='{"total": 7, "coding": {"grade": 7')
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="length")])
+        
+        monkeypatch.setattr(main, "IS_DUMMY_KEY", False)
+        monkeypatch.setattr(main, "create_chat_completion", fake_completion)
+        code = f"def twoSum(nums, target):  # {uuid.uuid4().hex}\n    pass"
+        for _ in range(2):
+            review = await CodeReviewAgent().review("c", "b", code, QUESTIONS_BY_ID[1], "python")
+            assert review["total"] is None
+        assert len(calls) == 2
+    
+    @pytest.mark.asyncio
+    async def test_malformed_combined_review_falls_back_uncached(self, monkeypatch):
+        """Test that a truncated combined reply gets the same fallback as a separate review"""
+        import main
+        calls = []
+        
+        async def fake_completion(**kwargs):
+            calls.append(kwargs)
+            message = SimpleNamespace(content='{"review": {"total": 7')
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="length")])
+        
+        monkeypatch.setattr(main, "IS_DUMMY_KEY", False)
+        monkeypatch.setattr(main, "create_chat_completion", fake_completion)
+        agent = main.CombinedReviewAgent(CodeReviewAgent(), ClarificationAgent(), BruteForceAgent(), main.OptimizeAgent())
+        code = f"def twoSum(nums, target):  # {uuid.uuid4().hex}\n    pass"
+        for _ in range(2):
+            review, *feedback = await agent.review("c", "b", code, QUESTIONS_BY_ID[1], "python")
+            assert review["total"] is None
+            assert review["key_pointers"] == '{"review": {"total": 7'
+            assert feedback == [None, None, None]
+        assert len(calls) == 2
+    
+    def test_review_schema(self):
+        """Test that review JSON is validated against the review model"""
+        ReviewResponse.model_validate(CodeReviewAgent.fallback_review)
+        with pytest.raises(ValueError):
+            ReviewResponse.model_validate_json('{"total": 7, "coding": {"grade": 7')
     
     def test_code_review_empty_code(self):
         """Test code review with empty code"""
@@ -172,6 +589,193 @@ class TestCodeReviewAPI:
         assert response.status_code == 422  # Validation error
 
 
+class TestAuthAPI:
+    """Test registration and login endpoints"""
+    
+    def test_register_and_login(self):
+        """Test registering a new user and logging in"""
+        username = f"user_{uuid.uuid4().hex[:8]}"
+        response = client.post("/api/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "Passw0rd!"
+        })
+        assert response.status_code == 200
+        
+        response = client.post("/api/login", json={
+            "username": username,
+            "password": "Passw0rd!"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["token_type"] == "bearer"
+        claims = jwt.decode(data["access_token"], settings.secret_key, algorithms=[settings.algorithm])
+        assert claims["sub"] == username
+        
+        response = client.get("/api/me", headers={"Authorization": f"Bearer {data['access_token']}"})
+        assert response.status_code == 200
+        assert response.json()["username"] == username
+    
+    def test_register_duplicate_username(self):
+        """Test that registering a taken username is rejected"""
+        username = f"user_{uuid.uuid4().hex[:8]}"
+        payload = {"username": username, "email": f"{username}@example.com", "password": "Passw0rd!"}
+        assert client.post("/api/register", json=payload).status_code == 200
+        
+        response = client.post("/api/register", json={**payload, "email": f"other_{username}@example.com"})
+        assert response.status_code == 400
+    
+    def test_me_requires_valid_token(self):
+        """Test that the current-user endpoint rejects missing and forged tokens"""
+        response = client.get("/api/me")
+        assert response.status_code == 401
+        
+        response = client.get("/api/me", headers={"Authorization": "Bearer not-a-token"})
+        assert response.status_code == 401
+    
+    def test_principal_is_cached_per_token(self):
+        """Test that a token's user is reused until the token itself expires"""
+        username = f"user_{uuid.uuid4().hex[:8]}"
+        client.post("/api/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "Passw0rd!"
+        })
+        token = create_access_token({"sub": username})
+        assert client.get("/api/me", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+        assert principal_cache[token][0].username == username
+        
+        user, _ = principal_cache[token]
+        principal_cache[token] = (user, 0)
+        response = client.get("/api/me", headers={"Authorization": f"Bearer {token}"})
+        # An entry past the token's exp is ignored and refreshed from a fresh decode
+        assert response.status_code == 200
+        assert principal_cache[token][1] > 0
+    
+    def test_login_rejects_bad_credentials(self):
+        """Test that unknown users and wrong passwords both get a 401"""
+        username = f"user_{uuid.uuid4().hex[:8]}"
+        client.post("/api/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "Passw0rd!"
+        })
+        response = client.post("/api/login", json={"username": username, "password": "wrong"})
+        assert response.status_code == 401
+        
+        response = client.post("/api/login", json={"username": f"missing_{username}", "password": "Passw0rd!"})
+        assert response.status_code == 401
+    
+    def test_repeat_login_is_served_from_cache(self):
+        """Test that a verified login is remembered without letting other passwords in"""
+        username = f"user_{uuid.uuid4().hex[:8]}"
+        client.post("/api/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "Passw0rd!"
+        })
+        cached = len(verified_logins)
+        assert client.post("/api/login", json={"username": username, "password": "Passw0rd!"}).status_code == 200
+        assert len(verified_logins) == cached + 1
+        assert client.post("/api/login", json={"username": username, "password": "Passw0rd!"}).status_code == 200
+        assert len(verified_logins) == cached + 1
+        assert client.post("/api/login", json={"username": username, "password": "wrong"}).status_code == 401
+    
+    def test_legacy_bcrypt_hash_is_upgraded(self):
+        """Test that bcrypt hashes still verify and are rehashed with argon2"""
+        legacy_hash = pwd_context.handler("bcrypt").hash("Passw0rd!")
+        valid, new_hash = pwd_context.verify_and_update("Passw0rd!", legacy_hash)
+        assert valid
+        assert new_hash.startswith("$argon2")
+
+
+class TestTokenBudget:
+    """Test prompt input truncation"""
+    
+    def test_short_text_is_unchanged(self):
+        """Test that text within the limit is passed through"""
+        assert truncate_tokens("Use a hash map", 100) == "Use a hash map"
+    
+    def test_long_text_is_truncated(self):
+        """Test that text over the limit is cut to the token budget"""
+        truncated = truncate_tokens("two sum " * 5000, 100)
+        assert truncated
+        assert count_tokens(truncated) <= 100
+    
+    def test_examples_are_trimmed_to_budget(self):
+        """Test that examples past the token budget are dropped, keeping at least the first"""
+        examples = [{"input": f"nums = [{i}] * 50", "output": str(i)} for i in range(20)]
+        kept = select_examples(examples, 40)
+        assert 1 <= len(kept) < len(examples)
+        assert kept[0].startswith("Input: nums = [0]")
+        assert len(select_examples(examples[:1], 0)) == 1
+    
+    def test_system_header_is_not_re_encoded(self, monkeypatch):
+        """Test that rate-limit estimates reuse the precomputed header count"""
+        import main
+        request = ClarificationAgent()._build_request("Can the array be empty?", QUESTIONS_BY_ID[1])
+        header, user = request["messages"]
+        expected = count_tokens(header["content"]) + count_tokens(user["content"]) + request["max_tokens"]
+        encoded = []
+        
+        def spy(text):
+            encoded.append(text)
+            return count_tokens(text)
+        
+        monkeypatch.setattr(main, "count_tokens", spy)
+        assert main.estimate_tokens(request) == expected
+        assert encoded == [user["content"]]
+
+
+class TestOpenAIRequests:
+    """Test the shared limits applied to every OpenAI call"""
+    
+    @pytest.mark.asyncio
+    async def test_embeddings_share_request_limit_and_deadline(self, monkeypatch):
+        """Test that semantic-cache embeddings take a request slot and time out like completions"""
+        import main
+        acquired = []
+        
+        class FakeLimiter:
+            async def acquire(self, amount=1):
+                acquired.append(amount)
+        
+        async def slow_embedding(**kwargs):
+            await asyncio.sleep(1)
+        
+        monkeypatch.setattr(main, "request_limiter", FakeLimiter())
+        monkeypatch.setattr(main, "token_limiter", FakeLimiter())
+        monkeypatch.setattr(main, "client", SimpleNamespace(embeddings=SimpleNamespace(create=slow_embedding)))
+        monkeypatch.setattr(settings, "openai_request_deadline", 0.01)
+        with pytest.raises(OpenAIError, match="timed out"):
+            await main.embed_text("Can the array be empty?")
+        assert acquired == [1]
+
+
+class TestCacheKeys:
+    """Test normalization of exact-cache keys"""
+    
+    def test_case_and_whitespace_are_normalized(self):
+        """Test that inputs differing only in case and spacing share a key"""
+        assert normalize_text("  Use a  Hash\nMap ") == normalize_text("use a hash map")
+
+
+class TestPromptPrefix:
+    """Test that stage prompts share a cacheable per-question prefix"""
+    
+    def test_system_header_is_shared_across_agents(self):
+        """Test that every agent leads with the same system message and keeps user input out of it"""
+        question = QUESTIONS_BY_ID[1]
+        headers = [
+            ClarificationAgent()._build_request("Can the array be empty?", question)["messages"][0],
+            BruteForceAgent()._build_request("Check all pairs", question)["messages"][0],
+            CodeReviewAgent()._build_request("c", "b", "def f(): pass", question, "python")["messages"][0]
+        ]
+        assert all(header == headers[0] for header in headers)
+        assert question["title"] in headers[0]["content"]
+        assert "Check all pairs" not in headers[0]["content"]
+
+
 class TestHealthCheck:
     """Test health check endpoint"""
     
@@ -182,6 +786,67 @@ class TestHealthCheck:
         data = response.json()
         assert data["status"] == "healthy"
         assert "timestamp" in data
+    
+    def test_security_and_timing_headers_are_set(self):
+        """Test that the ASGI middlewares decorate responses"""
+        response = client.get("/api/questions")
+        assert response.headers["x-content-type-options"] == "nosniff"
+        assert response.headers["x-frame-options"] == "DENY"
+        assert float(response.headers["x-process-time"]) >= 0
+    
+    def test_health_check_bypasses_custom_middleware(self):
+        """Test that probes neither use rate-limit slots nor go through the custom middlewares"""
+        response = client.get("/health")
+        assert response.status_code == 200
+        assert "x-ratelimit-remaining" not in response.headers
+        assert "x-process-time" not in response.headers
+    
+    def test_cors_preflight_is_cacheable(self):
+        """Test that preflight responses let the browser cache them"""
+        response = client.options("/api/clarify", headers={
+            "Origin": "http://localhost:3000",
+            "Access-Control-Request-Method": "POST",
+            "Access-Control-Request-Headers": "Content-Type"
+        })
+        assert response.status_code == 200
+        assert response.headers["access-control-allow-origin"] == "http://localhost:3000"
+        assert response.headers["access-control-max-age"] == "86400"
+
+
+
+class TestRateLimit:
+    """Test the per-IP sliding-window rate limiter"""
+    
+    def test_window_counts_requests_and_drops_expired(self):
+        """Test that each request uses a slot and timestamps older than the window are freed"""
+        remaining = int(client.get("/api/questions").headers["x-ratelimit-remaining"])
+        assert int(client.get("/api/questions").headers["x-ratelimit-remaining"]) == remaining - 1
+        
+        rate_limit_store["testclient"].appendleft(time.monotonic() - 120)
+        assert int(client.get("/api/questions").headers["x-ratelimit-remaining"]) == remaining - 2
+    
+    @pytest.mark.asyncio
+    async def test_shared_window_counts_across_workers(self):
+        """Test that the Redis-counted window rejects hits past the limit"""
+        counts = {}
+        
+        async def increment(keys, args):
+            counts[keys[0]] = counts.get(keys[0], 0) + 1
+            return counts[keys[0]]
+        
+        limiter = RateLimitMiddleware(app, requests_per_minute=2)
+        limiter._increment = increment
+        results = [await limiter._check_shared("10.0.0.1") for _ in range(3)]
+        assert [allowed for allowed, _, _ in results] == [True, True, False]
+        assert results[1][1] == 0
+    
+    @pytest.mark.asyncio
+    async def test_unreachable_redis_falls_back_to_local_window(self):
+        """Test that a Redis outage degrades to the per-process limit instead of failing"""
+        limiter = RateLimitMiddleware(app, requests_per_minute=5, redis_client=redis.from_url("redis://127.0.0.1:1"))
+        allowed, remaining, _ = await limiter._check_shared("10.0.0.2")
+        assert allowed
+        assert remaining == 4
 
 
 if __name__ == "__main__":
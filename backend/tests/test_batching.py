@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from batching import MicroBatcher
+
+
+class TestMicroBatcher:
+    """Test cross-request micro-batching"""
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_submissions_share_a_batch(self):
+        """Test that concurrent items are processed in one call, in order"""
+        batches = []
+        
+        async def process(items):
+            batches.append(items)
+            return [item * 2 for item in items]
+        
+        batcher = MicroBatcher(process, batch_size=8, max_wait=0.05)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        await batcher.close()
+        assert results == [0, 2, 4, 6, 8]
+        assert batches == [[0, 1, 2, 3, 4]]
+    
+    @pytest.mark.asyncio
+    async def test_batches_are_capped_at_batch_size(self):
+        """Test that submissions beyond batch_size spill into the next batch"""
+        batches = []
+        
+        async def process(items):
+            batches.append(items)
+            return items
+        
+        batcher = MicroBatcher(process, batch_size=2, max_wait=0.05)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(3)))
+        await batcher.close()
+        assert results == [0, 1, 2]
+        assert batches == [[0, 1], [2]]
+    
+    @pytest.mark.asyncio
+    async def test_failure_propagates_to_every_caller(self):
+        """Test that a failed batch raises for each submitter"""
+        async def process(items):
+            raise RuntimeError("upstream error")
+        
+        batcher = MicroBatcher(process, batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        await batcher.close()
+        assert all(isinstance(r, RuntimeError) for r in results)
+    
+    @pytest.mark.asyncio
+    async def test_result_count_mismatch_is_an_error(self):
+        """Test that a batch returning the wrong number of results fails"""
+        async def process(items):
+            return items[:1]
+        
+        batcher = MicroBatcher(process, batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        await batcher.close()
+        assert all(isinstance(r, ValueError) for r in results)
+    
+    @pytest.mark.asyncio
+    async def test_close_fails_queued_and_in_flight_submissions(self):
+        """Test that closing the batcher never leaves a submitter waiting"""
+        started = asyncio.Event()
+        
+        async def process(items):
+            started.set()
+            await asyncio.Event().wait()
+        
+        batcher = MicroBatcher(process, batch_size=1, max_wait=0.01)
+        in_flight = asyncio.ensure_future(batcher.submit(1))
+        await started.wait()
+        queued = [asyncio.ensure_future(batcher.submit(i)) for i in (2, 3)]
+        await asyncio.sleep(0)
+        await batcher.close()
+        results = await asyncio.wait_for(
+            asyncio.gather(in_flight, *queued, return_exceptions=True), 1
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert not batcher._tasks
+    
+    @pytest.mark.asyncio
+    async def test_close_fails_batch_being_collected(self):
+        """Test that items waiting for the batch window are failed on close"""
+        async def process(items):
+            return items
+        
+        batcher = MicroBatcher(process, batch_size=4, max_wait=10)
+        pending = [asyncio.ensure_future(batcher.submit(i)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        await batcher.close()
+        results = await asyncio.wait_for(asyncio.gather(*pending, return_exceptions=True), 1)
+        assert all(isinstance(r, RuntimeError) for r in results)
@@ -0,0 +1,119 @@
+import pytest
+from cache import ResponseCache, SemanticCache
+
+
+EMBEDDINGS = {
+    "two sum with nested loops": [1.0, 0.0, 0.0],
+    "two sum using nested loops": [0.99, 0.1, 0.0],
+    "two sum with a hash map": [0.0, 1.0, 0.0],
+}
+
+
+async def fake_embed(text):
+    return EMBEDDINGS[text]
+
+
+def make_compute(value, calls):
+    async def compute():
+        calls.append(value)
+        return value
+    return compute
+
+
+class TestResponseCache:
+    """Test the exact-match response cache"""
+    
+    @pytest.mark.asyncio
+    async def test_identical_key_hits(self):
+        """Test that a repeated key skips the computation"""
+        cache = ResponseCache()
+        calls = []
+        first = await cache.get_or_set(("clarify", 1, "same input"), make_compute("a", calls))
+        second = await cache.get_or_set(("clarify", 1, "same input"), make_compute("b", calls))
+        assert first == second == "a"
+        assert calls == ["a"]
+    
+    @pytest.mark.asyncio
+    async def test_different_key_misses(self):
+        """Test that a different key computes a new value"""
+        cache = ResponseCache()
+        calls = []
+        await cache.get_or_set(("clarify", 1, "same input"), make_compute("a", calls))
+        result = await cache.get_or_set(("clarify", 2, "same input"), make_compute("b", calls))
+        assert result == "b"
+        assert calls == ["a", "b"]
+    
+    @pytest.mark.asyncio
+    async def test_value_set_directly_is_served(self):
+        """Test that a value stored with set() satisfies a later get_or_set()"""
+        cache = ResponseCache()
+        calls = []
+        assert cache.get(("review", 1)) is None
+        cache.set(("review", 1), {"total": 7})
+        assert await cache.get_or_set(("review", 1), make_compute({}, calls)) == {"total": 7}
+        assert calls == []
+
+
+class TestSemanticCache:
+    """Test the embedding-similarity response cache"""
+    
+    @pytest.mark.asyncio
+    async def test_similar_text_hits(self):
+        """Test that a near-duplicate prompt reuses the cached response"""
+        cache = SemanticCache(fake_embed, threshold=0.9)
+        calls = []
+        first = await cache.get_or_set("ns", "two sum with nested loops", make_compute("a", calls))
+        second = await cache.get_or_set("ns", "two sum using nested loops", make_compute("b", calls))
+        assert first == second == "a"
+        assert calls == ["a"]
+    
+    @pytest.mark.asyncio
+    async def test_dissimilar_text_misses(self):
+        """Test that an unrelated prompt calls through"""
+        cache = SemanticCache(fake_embed, threshold=0.9)
+        calls = []
+        await cache.get_or_set("ns", "two sum with nested loops", make_compute("a", calls))
+        result = await cache.get_or_set("ns", "two sum with a hash map", make_compute("b", calls))
+        assert result == "b"
+        assert calls == ["a", "b"]
+    
+    @pytest.mark.asyncio
+    async def test_namespaces_are_isolated(self):
+        """Test that identical text in another namespace does not hit"""
+        cache = SemanticCache(fake_embed, threshold=0.9)
+        calls = []
+        await cache.get_or_set("clarify", "two sum with nested loops", make_compute("a", calls))
+        result = await cache.get_or_set("brute", "two sum with nested loops", make_compute("b", calls))
+        assert result == "b"
+    
+    @pytest.mark.asyncio
+    async def test_oldest_entry_evicted(self):
+        """Test that a full namespace drops its oldest entry"""
+        cache = SemanticCache(fake_embed, threshold=0.9, max_entries=1)
+        calls = []
+        await cache.get_or_set("ns", "two sum with nested loops", make_compute("a", calls))
+        await cache.get_or_set("ns", "two sum with a hash map", make_compute("b", calls))
+        await cache.get_or_set("ns", "two sum with nested loops", make_compute("c", calls))
+        assert calls == ["a", "b", "c"]
+    
+    @pytest.mark.asyncio
+    async def test_least_recent_namespace_evicted(self):
+        """Test that the number of namespaces is capped"""
+        cache = SemanticCache(fake_embed, threshold=0.9, max_namespaces=2)
+        calls = []
+        for namespace in ("a", "b", "c"):
+            await cache.get_or_set(namespace, "two sum with nested loops", make_compute(namespace, calls))
+        assert len(cache._namespaces) == 2
+        await cache.get_or_set("a", "two sum with nested loops", make_compute("a2", calls))
+        assert calls == ["a", "b", "c", "a2"]
+    
+    @pytest.mark.asyncio
+    async def test_embedding_failure_falls_through(self):
+        """Test that an embedding error still returns a computed response"""
+        async def broken_embed(text):
+            raise RuntimeError("embedding service down")
+        
+        cache = SemanticCache(broken_embed)
+        calls = []
+        result = await cache.get_or_set("ns", "anything", make_compute("a", calls))
+        assert result == "a"
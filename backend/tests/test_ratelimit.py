@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+import pytest
+from ratelimit import TokenBucket
+
+
+class TestTokenBucket:
+    """Test the proactive OpenAI rate limiter"""
+    
+    @pytest.mark.asyncio
+    async def test_acquire_within_capacity_does_not_wait(self):
+        """Test that a full bucket serves a burst immediately"""
+        bucket = TokenBucket(10, period=60)
+        start = time.monotonic()
+        for _ in range(10):
+            await bucket.acquire()
+        assert time.monotonic() - start < 0.05
+    
+    @pytest.mark.asyncio
+    async def test_acquire_waits_for_refill(self):
+        """Test that callers beyond capacity wait for the bucket to refill"""
+        bucket = TokenBucket(10, period=1)
+        await bucket.acquire(10)
+        start = time.monotonic()
+        await asyncio.gather(bucket.acquire(1), bucket.acquire(1))
+        # Two units refill at 10 per second, so the second caller waits ~0.2s
+        assert 0.15 < time.monotonic() - start < 0.5
+    
+    @pytest.mark.asyncio
+    async def test_oversized_request_is_capped_at_capacity(self):
+        """Test that a request larger than the bucket does not wait forever"""
+        bucket = TokenBucket(10, period=1)
+        start = time.monotonic()
+        await bucket.acquire(1000)
+        assert time.monotonic() - start < 0.05